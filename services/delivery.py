@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Delivery of reminders.
+
+Tasks reminded in the same tick are grouped by profile, and each profile gets one delivery (batch) per tick.
+Deliveries are sent to sinks concurrently. Each sink bounds its own concurrency and retries failures.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait
+from email.mime.text import MIMEText
+from twido.models import Config, UserProfile
+from collections import OrderedDict
+import abc
+import requests
+import simplejson as json
+import smtplib
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class SinkType(object):
+    LOG = 'log'
+    SMTP = 'smtp'
+    WEBHOOK = 'webhook'
+    CHANNEL = 'channel'
+    choices = (LOG, SMTP, WEBHOOK, CHANNEL)
+
+
+class Sink(object):
+    """
+    Base of reminder sinks.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    retry_errors = ()       # errors worth retrying
+
+    def __init__(self, concurrency=4, retries=3, backoff=1.0):
+        """
+        :param concurrency: max count of deliveries sent at the same time.
+        :param retries: max count of retries of a failed delivery.
+        :param backoff: seconds before the first retry. Doubled for each retry.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+
+    @property
+    def name(self):
+        return type(self).__name__
+
+    def route(self, batches):
+        """
+        :param batches: list of (profile, tasks)
+        :return: list of (sink, profile, tasks, kwargs of send)
+        """
+        return [(self, profile, tasks, {}) for profile, tasks in batches]
+
+    def deliver(self, profile, tasks, **kwargs):
+        """
+        Send with bounded concurrency, retrying failures.
+        """
+        with self._semaphore:
+            for retry in range(self.retries + 1):
+                try:
+                    return self.send(profile, tasks, **kwargs)
+                except self.retry_errors as err:
+                    if retry >= self.retries:
+                        raise
+                    log.warning('Fail to remind %s by %s. Retry %d. %s' % (profile, self.name, retry + 1, err))
+                    time.sleep(self.backoff * 2 ** retry)
+
+    @abc.abstractmethod
+    def send(self, profile, tasks, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def get_text(tasks):
+        return '\n'.join('%s (due at %s)' % (task.title, task.due) for task in tasks)
+
+
+class LogSink(Sink):
+
+    def send(self, profile, tasks, **kwargs):
+        log.info('Remind %s of %d tasks.\n%s' % (profile, len(tasks), self.get_text(tasks)))
+
+
+class SmtpSink(Sink):
+    """
+    One mail per profile per tick. Use a local SMTP stand-in for testing, such as
+    python -m smtpd -n -c DebuggingServer localhost:1025
+    """
+    retry_errors = (smtplib.SMTPException, OSError)
+
+    def __init__(self, host='localhost', port=1025, sender='noreply@localhost', username='', password='',
+                 concurrency=2, **kwargs):
+        super(SmtpSink, self).__init__(concurrency=concurrency, **kwargs)
+        self.host = host
+        self.port = int(port)
+        self.sender = sender
+        self.username = username
+        self.password = password
+
+    @staticmethod
+    def get_address(profile):
+        email = profile.email
+        if not email or email.endswith(UserProfile.get_temp_email_suffix()) or \
+                email.endswith(UserProfile.get_local_email_suffix()):
+            return None     # no real mailbox
+        return email
+
+    def send(self, profile, tasks, **kwargs):
+        to = self.get_address(profile)
+        if not to:
+            log.debug('No email address of %s. Reminder skipped.' % profile)
+            return
+        msg = MIMEText(self.get_text(tasks), 'plain', 'utf-8')
+        msg['Subject'] = '%d tasks are due' % len(tasks) if len(tasks) > 1 else '%s is due' % tasks[0].title
+        msg['From'] = self.sender
+        msg['To'] = to
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.sendmail(self.sender, [to], msg.as_string())
+
+
+class WebhookSink(Sink):
+    """
+    Post JSON of a profile's tasks to the webhook url (or url of the profile).
+    """
+    retry_errors = (requests.RequestException, )
+
+    def __init__(self, url='', timeout=10, concurrency=8, **kwargs):
+        super(WebhookSink, self).__init__(concurrency=concurrency, **kwargs)
+        self.url = url
+        self.timeout = timeout
+        self._local = threading.local()     # session per thread
+
+    @property
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def send(self, profile, tasks, url='', **kwargs):
+        url = url or self.url
+        if not url:
+            log.debug('No webhook of %s. Reminder skipped.' % profile)
+            return
+        data = {
+            'profile': profile.username,
+            'tasks': [{'id': task.id, 'title': task.title, 'due': task.due.isoformat() if task.due else None}
+                      for task in tasks],
+        }
+        r = self.session.post(url, data=json.dumps(data), timeout=self.timeout,
+                              headers={'Content-Type': 'application/json'})
+        r.raise_for_status()
+
+
+class ChannelSink(Sink):
+    """
+    Route to the channel configured by each user. (Config "remind_channel": log, smtp, webhook or none.
+    Config "remind_webhook": url of the user's webhook.)
+    """
+    conf_channel = 'remind_channel'
+    conf_webhook = 'remind_webhook'
+
+    def __init__(self, sinks, default=SinkType.LOG):
+        """
+        :param sinks: dict of channel -> sink.
+        :param default: channel of users not configured.
+        """
+        super(ChannelSink, self).__init__()
+        self.sinks = sinks
+        self.default = default
+
+    def route(self, batches):
+        confs = {}
+        profile_ids = [profile.id for profile, tasks in batches]
+        for i in range(0, len(profile_ids), 500):
+            for profile_id, name, value in Config.objects.filter(
+                    profile_id__in=profile_ids[i:i + 500], name__in=(self.conf_channel, self.conf_webhook)
+            ).values_list('profile_id', 'name', 'value'):
+                confs[(profile_id, name)] = value
+
+        routes = []
+        for profile, tasks in batches:
+            channel = confs.get((profile.id, self.conf_channel), self.default)
+            sink = self.sinks.get(channel)
+            if sink is None:
+                if channel != 'none':
+                    log.warning('Unknown reminder channel "%s" of %s.' % (channel, profile))
+                continue
+            kwargs = {}
+            if isinstance(sink, WebhookSink) and (profile.id, self.conf_webhook) in confs:
+                kwargs['url'] = confs[(profile.id, self.conf_webhook)]
+            routes.append((sink, profile, tasks, kwargs))
+        return routes
+
+    def send(self, profile, tasks, **kwargs):
+        for sink, profile, tasks, kwargs in self.route([(profile, tasks)]):
+            sink.deliver(profile, tasks, **kwargs)
+
+    def close(self):
+        for sink in self.sinks.values():
+            sink.close()
+
+
+class Dispatcher(object):
+    """
+    Reminder callback (on_remind) delivering tasks of a tick by batches per profile.
+    Returns tasks not delivered when all deliveries of the tick are done (or failed), so reminded time is
+    checkpointed after delivery and failed tasks are reminded again.
+    """
+
+    def __init__(self, sink, workers=8):
+        """
+        :param sink: Sink
+        :param workers: max count of deliveries in progress (of all sinks).
+        """
+        self.sink = sink
+        self.workers = workers
+        self._executor = None   # created on first use. (in the worker process when forked)
+        self._stats = {'tasks': 0, 'batches': 0, 'failed': 0}
+
+    def __call__(self, tasks):
+        return self.dispatch(tasks)
+
+    @staticmethod
+    def group(tasks):
+        """
+        :return: list of (profile, tasks of the profile)
+        """
+        batches = OrderedDict()
+        for task in tasks:
+            batches.setdefault(task.profile_id, (task.profile, []))[1].append(task)
+        return list(batches.values())
+
+    def dispatch(self, tasks):
+        """
+        :return: list of tasks failed to deliver (after retries).
+        """
+        routes = self.sink.route(self.group(tasks))
+        if not routes:
+            return []
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        futures = dict((self._executor.submit(sink.deliver, profile, batch, **kwargs), (sink, profile, batch))
+                       for sink, profile, batch, kwargs in routes)
+        wait(futures)
+        failed = []
+        for future, (sink, profile, batch) in futures.items():
+            err = future.exception()
+            if err is not None:
+                self._stats['failed'] += 1
+                log.error('Fail to remind %s by %s. %s' % (profile, sink.name, err))
+                failed.extend(batch)
+        self._stats['tasks'] += len(tasks)
+        self._stats['batches'] += len(routes)
+        return failed
+
+    def get_stats(self):
+        return dict(self._stats)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.sink.close()
+
+
+def create_sink(sink_type=SinkType.LOG, cfgs=None):
+    """
+    :param sink_type: SinkType
+    :param cfgs: [reminder] section of config. (smtp_host, smtp_port, smtp_sender, smtp_username, smtp_password,
+                 webhook_url)
+    """
+    cfgs = cfgs or {}
+    if sink_type == SinkType.LOG:
+        return LogSink()
+    elif sink_type == SinkType.SMTP:
+        return SmtpSink(host=cfgs.get('smtp_host') or 'localhost', port=cfgs.get('smtp_port') or 1025,
+                        sender=cfgs.get('smtp_sender') or 'noreply@localhost',
+                        username=cfgs.get('smtp_username') or '', password=cfgs.get('smtp_password') or '')
+    elif sink_type == SinkType.WEBHOOK:
+        return WebhookSink(url=cfgs.get('webhook_url') or '')
+    elif sink_type == SinkType.CHANNEL:
+        return ChannelSink(sinks=dict((t, create_sink(t, cfgs)) for t in (SinkType.LOG, SinkType.SMTP,
+                                                                           SinkType.WEBHOOK)))
+    raise ValueError('Unknown sink type %s' % sink_type)
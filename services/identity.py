@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+In-process identity map of models frequently referenced while parsing.
+(social accounts, default lists and profiles)
+
+Entries are bounded by LRU and invalidated when the models are saved or deleted in this process.
+The map caches only while it's open (such as during a parse run).
+"""
+from django.db.models.signals import post_save, post_delete
+from twido.models import SocialAccount, UserProfile, List
+from twido.utils import LRUCache
+from collections import OrderedDict
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class IdentityMap(object):
+
+    def __init__(self, size=10000):
+        """
+        :param size: max count of entries of each model.
+        """
+        self.accounts = LRUCache(size)          # (platform, account) -> SocialAccount
+        self.default_lists = LRUCache(size)     # profile id -> default List
+        self.profiles = LRUCache(size)          # profile id -> UserProfile
+        self._opened = False
+
+    def open(self):
+        """
+        Start caching. Entries are invalidated on saving/deleting models until closed.
+        """
+        if not self._opened:
+            for sender, receiver in self.__receivers():
+                post_save.connect(receiver, sender=sender, weak=True)
+                post_delete.connect(receiver, sender=sender, weak=True)
+            self._opened = True
+        return self
+
+    def close(self):
+        if self._opened:
+            for sender, receiver in self.__receivers():
+                post_save.disconnect(receiver, sender=sender)
+                post_delete.disconnect(receiver, sender=sender)
+            self._opened = False
+        self.clear()
+
+    def clear(self):
+        self.accounts.clear()
+        self.default_lists.clear()
+        self.profiles.clear()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __receivers(self):
+        return ((SocialAccount, self._on_account_changed), (List, self._on_list_changed),
+                (UserProfile, self._on_profile_changed))
+
+    def _on_account_changed(self, sender, instance, **kwargs):
+        self.accounts.pop((instance.platform, instance.account))
+
+    def _on_list_changed(self, sender, instance, **kwargs):
+        self.default_lists.pop(instance.profile_id)
+
+    def _on_profile_changed(self, sender, instance, **kwargs):
+        self.profiles.pop(instance.id)
+
+    def get_profile(self, profile_id):
+        profile = self.profiles.get(profile_id) if self._opened else None
+        if profile is None:
+            profile = UserProfile.objects.get(id=profile_id)
+            if self._opened:
+                self.profiles.set(profile_id, profile)
+        return profile
+
+    def get_default_list(self, profile):
+        default_list = self.default_lists.get(profile.id) if self._opened else None
+        if default_list is None:
+            default_list = List.get_default(profile)
+            if self._opened:
+                self.default_lists.set(profile.id, default_list)
+        return default_list
+
+    def get_accounts(self, platform, user_objs, build):
+        """
+        Resolve social accounts of users. Accounts missing in map are queried at once,
+        and accounts not existing are created by bulk.
+        :param platform: social platform of users
+        :param user_objs: list of user objects (of statuses)
+        :param build: function builds an unsaved SocialAccount from a user object.
+        :return: list of SocialAccount in the order of user_objs. Their profiles are resolved from the map.
+        """
+        found = {}
+        missing = OrderedDict()
+        for user in user_objs:
+            acc = self.accounts.get((platform, user.screen_name)) if self._opened else None
+            if acc is None:
+                missing[user.screen_name] = user
+            else:
+                found[user.screen_name] = acc
+
+        if missing:
+            loaded = list(SocialAccount.objects.filter(platform=platform, account__in=list(missing.keys())))
+            existing = set(acc.account for acc in loaded)
+            created = [build(user) for name, user in missing.items() if name not in existing]
+            if created:
+                SocialAccount.objects.bulk_create(created)
+                loaded.extend(SocialAccount.objects.filter(platform=platform,
+                                                           account__in=[acc.account for acc in created]))
+                log.debug('Created %d social accounts by bulk.' % len(created))
+
+            for acc in loaded:
+                acc.profile = self.get_profile(acc.profile_id)
+                found[acc.account] = acc
+                if self._opened:
+                    self.accounts.set((platform, acc.account), acc)
+
+        return [found[user.screen_name] for user in user_objs]
+
+    def get_stats(self):
+        return {
+            'accounts': self.accounts.get_stats(),
+            'default_lists': self.default_lists.get_stats(),
+            'profiles': self.profiles.get_stats(),
+        }
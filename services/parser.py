@@ -5,23 +5,26 @@
 Module to parse a tweets/status
 """
 from django.db import transaction
-from pyutils.json import to_serializable
 
 from twido.models import RawStatus, SocialPlatform, Visibility
 from twido.models import SocialAccount, UserProfile
-from twido.models import Task, List
+from twido.models import Task
 from twido.models.task import TaskMeta
+from twido.models.fields import RawJSON
 from twido.parser import Timex3Parser
 
 from .storage import StorageType, StorageMixin
+from .timex import Timex3Client
+from .identity import IdentityMap
 from pyutils.langutil import MutableEnum
 from twido.utils import parse_datetime
 from django.utils.timezone import utc
 from django.db.utils import IntegrityError
 
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import abc
-import os
-import re
 import simplejson as json
 import requests
 try:
@@ -32,108 +35,276 @@ except ImportError:
 import logging
 log = logging.getLogger(__name__)
 
-re_hashtag = re.compile(r'(?P<hash>#(todo|wish))(\s|\Z)', re.IGNORECASE + re.MULTILINE)
-
-
-def test_re():
-    m = re_hashtag.search('''#Looking for something #todo while in #LasVegas
-    #partybus #trucklimo #limo #SUV #reserve one and have a
-    #goodtime https://t.co/qlBi4BAcXF''')
-    print(m)
-    print(m.groupdict()['hash'] if m else None)
-    print(m.group(0))
-    print(m.group(1))
-
-    m = re_hashtag.search('''#toDO RT HacksterPro... while in #LasVegas
-    #partybus #trucklimo #limo #SUV #reserve one and have a
-    #goodtime https://t.co/qlBi4BAcXF''')
-    print(m)
-    print(m.groups() if m else None)
-
-    m = re_hashtag.search('''HacksterPro... while in #LasVegas
-    #partybus #trucklimo #limo #SUV #reserve one and have a
-    #goodtime https://t.co/qlBi4BAcXF blabla#WISH''')
-    print(m)
-    print(m.groups() if m else None)
-
-    m = re_hashtag.search('''HacksterPro... while in #LasVegas
-    #partybus #trucklimo #limo #SUV #reserve #WISHME one and have a
-    #goodtime https://t.co/qlBi4BAcXF blabla''')
-    print(m)
-    print(m.groups() if m else None)
-
-# test_re()
-# exit(0)
-
-
 class Parser(StorageMixin):
     """
     Abstract base class for parsing social status
     """
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, endpoint, storage=StorageType.DB):
+    valid_tags = set(Timex3Parser.valid_tags)
+    max_write_batch_size = 500      # keep "IN (...)" of a chunk under sqlite variables limit (999)
+
+    def __init__(self, endpoint, storage=StorageType.DB, workers=1, timeout=30, retries=3, batch_size=1,
+                 cache=None, write_batch_size=200):
+        """
+        :param endpoint: TIMEX3 parser endpoint
+        :param storage:
+        :param workers: count of concurrent requests to endpoint.
+        :param timeout: seconds to wait for endpoint response.
+        :param retries: max retries of failed endpoint requests.
+        :param batch_size: count of statuses annotated in one endpoint request. 1 means no batch.
+        :param cache: AnnotationCache instance in front of endpoint. None means no cache.
+        :param write_batch_size: count of statuses filtered and saved to DB by bulk at a time. (max 500)
+        """
         super(Parser, self).__init__(storage=storage)
         self._endpoint = endpoint
+        self._workers = workers
+        self._batch_size = max(batch_size, 1)
+        self._write_batch_size = min(max(write_batch_size, 1), self.max_write_batch_size)
+        self._cache = cache
+        self._identity = IdentityMap()
+        self._dropped = 0
+        self._client = Timex3Client(endpoint, pool_size=max(workers, 1), timeout=timeout, retries=retries)
 
     def parse_status(self, status_json):
+        status_obj = self._load_status(status_json)
+        return self._save_status(status_obj)
 
-        # TODO: user bulk_create to batch create tasks.
-        # TODO: add commit=False arguments to speicify wether save.
-        # TODO: storage "parsed" commitment moves out
+    def parse_statuses(self, items):
+        """
+        Parse statuses in a pipeline. Items are read by chunks of write batch size. Statuses without valid
+        hash tags are dropped (marked parsed) by chunk first. The rest are annotated by endpoint batches of
+        batch size. Endpoint requests run concurrently in a pool of workers, while results are saved by this
+        (single writer) thread in the order of items. Tasks of a chunk are created by bulk in one transaction.
+        :param items: iterable of (key, status_json)
+        :return: generator of (key, succeed) in the order of items
+        """
+        with self._identity:
+            for result in self._parse_statuses(items):
+                yield result
+            log.debug('Identity map stats: %s' % self._identity.get_stats())
+
+    def _parse_statuses(self, items):
+        workers = max(self._workers, 1)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk in self._chunks(items, self._write_batch_size):
+                chunk = [(key, self._load_status(status_json)) for key, status_json in chunk]
+                flags = self._filter_chunk(chunk)
+                kept = [status_obj for (key, status_obj), flag in zip(chunk, flags) if flag]
+                futures = [executor.submit(self._parse_texts, batch) for batch in self._chunks(kept, self._batch_size)]
+                pending.append((chunk, flags, futures))
+                # read ahead one chunk. the endpoint annotates it while the previous one is saved.
+                if len(pending) > 1:
+                    for result in self._save_chunk(*pending.popleft()):
+                        yield result
+
+            while pending:
+                for result in self._save_chunk(*pending.popleft()):
+                    yield result
+
+    @staticmethod
+    def _chunks(items, size):
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _filter_chunk(self, chunk):
+        """
+        Drop statuses without valid hash tags before any endpoint request or saving. Texts of the chunk (of write
+        batch size) are matched by one regex scan. Dropped statuses are marked parsed by one update.
+        :param chunk: list of (key, status_obj)
+        :return: list of bool (kept or not) in the order of chunk
+        """
+        flags = Timex3Parser.has_valid_tags([status_obj.text for key, status_obj in chunk])
+        dropped = [status_obj.id_str for (key, status_obj), flag in zip(chunk, flags) if not flag]
+        if dropped:
+            self._dropped += len(dropped)
+            log.debug('DROPPED %d of %d statuses due to no valid hash tags (%s).' % (
+                len(dropped), len(chunk), self.valid_tags))
+            if StorageType.contains_DB(self.storage):
+                RawStatus.objects.filter(rawid__in=dropped).update(parsed=True)
+        return flags
+
+    def _save_chunk(self, chunk, flags, futures):
+        """
+        :return: list of (key, succeed) of chunk. Dropped statuses are succeed.
+        """
+        kept = [(key, status_obj) for (key, status_obj), flag in zip(chunk, flags) if flag]
+        results = iter(self._save_annotated(kept, futures) if kept else ())
+        return [next(results) if flag else (key, True) for (key, status_obj), flag in zip(chunk, flags)]
 
-        status_obj = MutableEnum(json.loads(status_json))
-        status_obj.user = MutableEnum(status_obj.user)
-        status_obj._json = status_json
+    def _save_annotated(self, chunk, futures):
+        """
+        Save a chunk of annotated statuses. Chunk of more than one status is saved by bulk.
+        :param futures: futures of annotation results of endpoint batches of chunk, in order.
+        :return: list of (key, succeed)
+        """
+        if len(chunk) == 1:
+            key, status_obj = chunk[0]
+            return [(key, self._save_status(status_obj, lambda: futures[0].result()[0]))]
+
+        annotated = []
+        for batch, future in zip(self._chunks(chunk, self._batch_size), futures):
+            try:
+                annotated.extend(future.result())
+            except requests.exceptions.RequestException as err:
+                annotated.extend([('CONNECTION lost. %s' % err, False)] * len(batch))
+        if not any(succeed for xml, succeed in annotated):
+            for (key, status_obj), (xml, succeed) in zip(chunk, annotated):
+                log.error('FAILED. status(rawid=%s). %s' % (status_obj.id_str, xml))
+            return [(key, False) for key, status_obj in chunk]
 
+        try:
+            with transaction.atomic():
+                return self._bulk_save(chunk, annotated)
+        except IntegrityError as err:
+            log.warning('Fail to save chunk of %d statuses by bulk. Save one by one. Error:%s' % (len(chunk), err))
+            self._identity.clear()      # may hold accounts created in the rolled back transaction
+            return [(key, self._save_status(status_obj, lambda result=result: result))
+                    for (key, status_obj), result in zip(chunk, annotated)]
+
+    def _bulk_save(self, chunk, annotated):
+        """
+        Create tasks (and metas) of a chunk by bulk and mark statuses parsed with one update.
+        Must be called in a transaction.
+        :param chunk: list of (key, status_obj)
+        :param annotated: list of (TIMEX3 xml, succeed) of statuses in chunk
+        :return: list of (key, succeed)
+        """
+        accounts = self._identity.get_accounts(self.social_platform, [status_obj.user for key, status_obj in chunk],
+                                               self._build_social_account)
+        statuses = self._get_or_create_statuses([status_obj for key, status_obj in chunk])
+        existing = set(Task.objects.filter(raw__in=[status.id for status in statuses.values()])
+                                   .values_list('raw_id', flat=True))
+
+        results = []
+        parsed_ids = []
+        tasks = []
+        metas = []
+        for (key, obj), acc, (xml, succeed) in zip(chunk, accounts, annotated):
+            status = statuses[obj.id_str]
+            if not succeed:
+                log.error('FAILED. %s. %s' % (status, xml))
+                results.append((key, False))
+                continue
+
+            results.append((key, True))
+            parsed_ids.append(status.id)
+            if status.id in existing:
+                log.error('IGNORED due to duplicated. %s.' % status)
+                continue
+
+            task, meta = self._build_task(obj, acc, status, xml)
+            if task is None:
+                log.info('IGNORED due to no valid hash tags (%s). %s' % (self.valid_tags, status))
+                continue
+            existing.add(status.id)
+            tasks.append(task)
+            metas.append(meta)
+
+        if tasks:
+            Task.objects.bulk_create(tasks)
+            if tasks[0].id is None:
+                # ids are not returned by some backends (such as sqlite). query them back.
+                ids = dict(Task.objects.filter(raw__in=[task.raw_id for task in tasks]).values_list('raw_id', 'id'))
+                for task in tasks:
+                    task.id = ids[task.raw_id]
+            for task, meta in zip(tasks, metas):
+                meta.task = task
+            TaskMeta.objects.bulk_create(metas)
+            log.debug('SAVED %d tasks by bulk.' % len(tasks))
+
+        if parsed_ids and StorageType.contains_DB(self.storage):
+            RawStatus.objects.filter(id__in=parsed_ids).update(parsed=True)
+
+        return results
+
+    def _get_or_create_statuses(self, status_objs):
+        """
+        :return: dict of rawid -> RawStatus of status objects. Missing statuses are created by bulk.
+        """
+        rawids = [obj.id_str for obj in status_objs]
+        statuses = dict((status.rawid, status) for status in
+                        RawStatus.objects.filter(rawid__in=rawids).defer('raw_text', 'raw_data'))
+
+        missing = OrderedDict()
+        for obj in status_objs:
+            if obj.id_str not in statuses and obj.id_str not in missing:
+                missing[obj.id_str] = self.generate_status(obj)
+        if missing:
+            RawStatus.objects.bulk_create(missing.values())
+            statuses.update((status.rawid, status) for status in
+                            RawStatus.objects.filter(rawid__in=missing.keys()).defer('raw_text', 'raw_data'))
+            log.debug('Created %d statuses by bulk.' % len(missing))
+        return statuses
+
+    def _load_status(self, status_json):
+        obj = json.loads(status_json)
+        status_obj = MutableEnum(obj)
+        status_obj.user = MutableEnum(obj['user'])
+        status_obj._json = obj
+        return status_obj
+
+    def _save_status(self, status_obj, annotate=None):
         log.debug('Parsing %s' % status_obj.id_str)
 
         acc = self._parse_social_account(status_obj.user)
-        return self._parse_task(status_obj, acc)
+        return self._parse_task(status_obj, acc, annotate)
 
     def _parse_social_account(self, user_obj):
         """
-        Generate Social account from status user information
+        Get or create Social account from status user information
         :param user_obj:
         :return: instance of SocialAccount model
         """
-        user = user_obj
-        try:
-            acc = SocialAccount.objects.get(account=user.screen_name)
-        except SocialAccount.DoesNotExist:
-            acc = SocialAccount()
-            acc.profile = UserProfile.get_sys_profile()
-            acc.account = user.screen_name
-            acc.name = user.name
-            acc.rawid = user.id_str
-            if isinstance(user.created_at, str):
-                acc.created_at = parse_datetime(user.created_at).replace(tzinfo=utc)
-            else:
-                acc.created_at = user.created_at.replace(tzinfo=utc)
-
-            acc.timezone = user.time_zone
-            acc.location = user.location
-            acc.lang = user.lang
-            acc.utc_offset = user.utc_offset or 0
-            acc.img_url = user.profile_image_url
-            acc.img_url_https = user.profile_image_url_https
+        return self._identity.get_accounts(self.social_platform, [user_obj], self._build_social_account)[0]
 
-            acc.followers_count = user.followers_count
-            # acc.followings_count = user.followings_count
-            acc.favorites_count = user.favourites_count
-            acc.statuses_count = user.statuses_count
-            acc.friends_count = user.friends_count
-            acc.listed_count = user.listed_count
-
-            acc.save()
+    def _build_social_account(self, user_obj):
+        """
+        Generate Social account (not saved) from status user information
+        :param user_obj:
+        :return: instance of SocialAccount model
+        """
+        user = user_obj
+        acc = SocialAccount()
+        acc.platform = self.social_platform
+        acc.profile = UserProfile.get_sys_profile()
+        acc.account = user.screen_name
+        acc.name = user.name
+        acc.rawid = user.id_str
+        if isinstance(user.created_at, str):
+            acc.created_at = parse_datetime(user.created_at).replace(tzinfo=utc)
+        else:
+            acc.created_at = user.created_at.replace(tzinfo=utc)
+
+        acc.timezone = user.time_zone
+        acc.location = user.location
+        acc.lang = user.lang
+        acc.utc_offset = user.utc_offset or 0
+        acc.img_url = user.profile_image_url
+        acc.img_url_https = user.profile_image_url_https
+
+        acc.followers_count = user.followers_count
+        # acc.followings_count = user.followings_count
+        acc.favorites_count = user.favourites_count
+        acc.statuses_count = user.statuses_count
+        acc.friends_count = user.friends_count
+        acc.listed_count = user.listed_count
 
         return acc
 
-    def _parse_task(self, status_obj, social_account):
+    def _parse_task(self, status_obj, social_account, annotate=None):
         """
 
         :param status_obj:
         :param social_account:
+        :param annotate: function returns (TIMEX3 xml, succeed) of the status. Default requests endpoint.
         :return:
         """
         obj = status_obj
@@ -148,40 +319,20 @@ class Parser(StorageMixin):
             log.debug('Created status %s' % status)
 
         try:
-            xml, succeed = self._parse_text(obj.text, obj.created_at)
+            if annotate is None:
+                xml, succeed = self._parse_text(obj.text, obj.created_at)
+            else:
+                xml, succeed = annotate()
             if not succeed:
                 log.error('FAILED. %s. %s' % (status, xml))
                 return False
-        except requests.exceptions.ConnectionError as err:
+        except requests.exceptions.RequestException as err:
             log.error('CONNECTION lost. %s. %s' % (status, err))
             return False
 
-        # TODO: parse in a thread/process
         try:
-            meta = TaskMeta()
-            valid_tags = {'todo', 'wish'}
-            tags = Timex3Parser.parse_hash_tags(obj.text)
-            if valid_tags & set(tags):
-
-                task = Task()
-                task.list = List.get_default(acc.profile)
-                task.deadline = None
-                task.profile = acc.profile
-                task.social_account = acc
-                task.raw = status
-                if isinstance(obj.created_at, str):
-                    task.created_at = parse_datetime(obj.created_at).replace(tzinfo=utc)
-                else:
-                    task.created_at = obj.created_at.replace(tzinfo=utc)
-                task.title = obj.text
-                task.text = ''
-                task.visibility = Visibility.PUBLIC     # public if from social platform
-                task.labels = ','.join(tags)
-
-                meta.tags = json.dumps(tags, indent=2)
-                meta.dates = json.dumps(Timex3Parser.parse_dates(xml), indent=2, default=to_serializable)
-                meta.simple_text = Timex3Parser.parse_text(obj.text)
-                meta.timex = xml
+            task, meta = self._build_task(obj, acc, status, xml)
+            if task is not None:
                 with transaction.atomic():
                     task.save()
                     meta.task = task
@@ -189,7 +340,7 @@ class Parser(StorageMixin):
 
                 log.debug('SAVED task %s. (rawid: %s)' % (task, status.rawid))
             else:
-                log.info('IGNORED due to no valid hash tags (%s). %s' % (valid_tags, status))
+                log.info('IGNORED due to no valid hash tags (%s). %s' % (self.valid_tags, status))
 
         except IntegrityError as err:
             log.error('IGNORED due to duplicated. %s. Error:%s' % (status, err))
@@ -201,24 +352,92 @@ class Parser(StorageMixin):
 
         return True
 
+    def _build_task(self, status_obj, social_account, status, xml):
+        """
+        Build task and its meta (not saved) of an annotated status.
+        :return: tuple of (Task, TaskMeta), or (None, None) if status has no valid hash tags.
+        """
+        obj = status_obj
+        acc = social_account
+
+        tags = Timex3Parser.parse_hash_tags(obj.text)
+        if not self.valid_tags & set(tags):
+            return None, None
+
+        task = Task()
+        task.list = self._identity.get_default_list(acc.profile)
+        task.deadline = None
+        task.profile = acc.profile
+        task.social_account = acc
+        task.raw = status
+        if isinstance(obj.created_at, str):
+            task.created_at = parse_datetime(obj.created_at).replace(tzinfo=utc)
+        else:
+            task.created_at = obj.created_at.replace(tzinfo=utc)
+        task.title = obj.text
+        task.text = ''
+        task.visibility = Visibility.PUBLIC     # public if from social platform
+        task.labels = ','.join(tags)
+
+        docs = Timex3Parser.extract(xml, include_highlight=True)
+        meta = TaskMeta()
+        meta.tags = tags
+        meta.dates = RawJSON(docs[0]['dates_json']) if docs else []     # already encoded
+        meta.simple_text = Timex3Parser.parse_text(obj.text)
+        meta.timex = xml
+        if docs:
+            meta.set_timex_html(docs[0]['highlight'])
+        return task, meta
+
     def _parse_text(self, text, dt):
+        if self._cache is not None:
+            xml = self._cache.get(text, dt)
+            if xml is not None:
+                return xml, True
+
+        xml, succeed = self._client.annotate(text, dt)
+        if succeed and self._cache is not None:
+            self._cache.set(text, dt, xml)
+        return xml, succeed
 
-        payload = {
-            'text': text,
-            'date': dt
+    def _parse_texts(self, status_objs):
+        """
+        :return: list of (TIMEX3 xml, succeed) of statuses. Requested in one batch if more than one.
+        """
+        if len(status_objs) == 1:
+            return [self._parse_text(status_objs[0].text, status_objs[0].created_at)]
+        if self._cache is None:
+            return self._client.annotate_batch([(obj.text, obj.created_at) for obj in status_objs])
+
+        # request cache missed statuses only. duplicates in the chunk are requested once.
+        results = [None] * len(status_objs)
+        missed = OrderedDict()      # key -> indexes of statuses
+        for i, obj in enumerate(status_objs):
+            xml = self._cache.get(obj.text, obj.created_at)
+            if xml is None:
+                missed.setdefault(self._cache.make_key(obj.text, obj.created_at), []).append(i)
+            else:
+                results[i] = (xml, True)
+
+        if missed:
+            firsts = [status_objs[indexes[0]] for indexes in missed.values()]
+            annotated = self._client.annotate_batch([(obj.text, obj.created_at) for obj in firsts])
+            for obj, indexes, (xml, succeed) in zip(firsts, missed.values(), annotated):
+                if succeed:
+                    self._cache.set(obj.text, obj.created_at, xml)
+                for i in indexes:
+                    results[i] = (self._cache.rebase(xml, status_objs[i].created_at) if succeed else xml, succeed)
+        return results
+
+    def get_stats(self):
+        """
+        :return: dict of endpoint and cache stats.
+        """
+        return {
+            'dropped': self._dropped,
+            'endpoint': self._client.get_stats(),
+            'cache': self._cache.get_stats() if self._cache is not None else None,
         }
-        r = requests.get(self._endpoint, params=payload)
-        log.debug('HTTP status code: %d' % r.status_code)
-        # log.debug(r.text)
-
-        succeed = False
-        if r.text.startswith('error:'):
-            succeed = False
-        elif 200 <= r.status_code < 300:
-            succeed = True
-        else:
-            succeed = False
-        return r.text, succeed
 
     @abc.abstractmethod
     def parse(self):
@@ -233,52 +452,45 @@ class Parser(StorageMixin):
 
 class TwitterParser(Parser):
 
+    __cursor_name = 'parser'
+
     @property
     def social_platform(self):
         return SocialPlatform.TWITTER
 
     def parse(self, include_parsed=False):
 
-        last_id = self.get_last_id()
+        last_id = int(self.get_last_id())
         log.info('Start parsing (last_id=%s) ...' % last_id)
 
         if StorageType.contains_DB(self.storage):
             filter_kwargs = {}
             if not include_parsed:
                 filter_kwargs['parsed'] = False
-            for status in RawStatus.objects.filter(id__gt=int(last_id), source=self.social_platform,
-                                                   **filter_kwargs).order_by('id').iterator():
-                self.parse_status(status.raw)
-                id_str = str(status.id)
-                if last_id < id_str:
-                    last_id = id_str
+            statuses = RawStatus.objects.filter(id__gt=last_id, source=self.social_platform,
+                                                **filter_kwargs).order_by('id').iterator()
+            items = ((status.id, status.raw or self.load_raw(status.rawid)) for status in statuses)
+            for status_id, succeed in self.parse_statuses(items):
+                last_id = max(last_id, status_id)
 
         elif StorageType.contains_FILE(self.storage):
-
-            subfolders = sorted(os.listdir(self.data_folder))
-            name = '%s.json' % last_id
-
-            for sub in subfolders:
-                path = os.path.join(self.data_folder, sub)
-                if not os.path.isdir(path):
-                    continue
-                files = sorted(os.listdir(path))
-                for file in files:
-                    # p = os.path.join(self.data_folder, sub, file)
-                    # os.rename(p, p[:-7])
-                    if file > name and (include_parsed or not file.endswith('.parsed')):
-                        path = os.path.join(self.data_folder, sub, file)
-                        status_json = open(path, 'rt', encoding='utf-8').read()
-                        if self.parse_status(status_json):
-                            if not path.endswith('.parsed'):
-                                os.rename(path, path + '.parsed')
-                    id_str = name[:-5]
-                    if last_id < id_str:
-                        last_id = id_str
-                    name = file
+            # read segment log sequentially from cursor. cursor stops at the first failed status.
+            segment_log = self.segment_log
+            cursor = 0 if include_parsed else segment_log.get_cursor(self.__cursor_name)
+            failed = False
+            items = ((offset, data.decode('utf-8')) for offset, data in segment_log.read(cursor))
+            for offset, succeed in self.parse_statuses(items):
+                if succeed:
+                    if not failed:
+                        cursor = offset + 1
+                else:
+                    failed = True
+            segment_log.set_cursor(self.__cursor_name, cursor)
+            log.info('Parsing done (cursor=%s). Stats: %s' % (cursor, self.get_stats()))
+            return
 
         else:
             raise ValueError('Unsupported storage type %s' % self.storage)
 
-        self.save_last_id(last_id)
-        log.info('Parsing done (last_id=%s).' % last_id)
\ No newline at end of file
+        self.save_last_id(str(last_id))
+        log.info('Parsing done (last_id=%s). Stats: %s' % (last_id, self.get_stats()))
\ No newline at end of file
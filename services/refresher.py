@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Background refresher of social account stats. (followers, statuses and etc.)
+
+Accounts not refreshed for a while are looked up by batches (Twitter users/lookup, 100 users per call).
+Only changed columns are written. Unchanged accounts are touched by one update per batch.
+"""
+from datetime import timedelta
+from django.db import connection
+from django.utils import timezone
+from twido.models import SocialAccount, SocialPlatform
+from social.twitter import TwitterClientManager
+import time
+import tweepy
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class TwitterAccountRefresher(object):
+
+    lookup_size = 100       # max users per users/lookup call
+    lookup_budget = 900     # users/lookup calls allowed per window (user auth)
+
+    # SocialAccount field -> Twitter user attribute
+    fields = (
+        ('name', 'name'),
+        ('location', 'location'),
+        ('lang', 'lang'),
+        ('timezone', 'time_zone'),
+        ('utc_offset', 'utc_offset'),
+        ('img_url', 'profile_image_url'),
+        ('img_url_https', 'profile_image_url_https'),
+        ('followers_count', 'followers_count'),
+        ('favorites_count', 'favourites_count'),
+        ('statuses_count', 'statuses_count'),
+        ('friends_count', 'friends_count'),
+        ('listed_count', 'listed_count'),
+    )
+
+    def __init__(self, consumer_key, consumer_secret, access_token, access_token_secret,
+                 stale_hours=24, proxy=''):
+        """
+        :param stale_hours: accounts not refreshed (saved) within the hours are refreshed.
+        """
+        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+        self.api = TwitterClientManager.create_api_client(auth, access_token, access_token_secret, proxy=proxy or '',
+                                                          rate_limited=True)
+        self.api.scheduler.set_budget('lookup_users', self.lookup_budget)
+        self.stale_hours = stale_hours
+
+    def get_stale_accounts(self):
+        """
+        :return: queryset of stale accounts, the stalest first.
+        """
+        before = timezone.now() - timedelta(hours=self.stale_hours)
+        return SocialAccount.objects.filter(platform=SocialPlatform.TWITTER, timestamp__lt=before) \
+                                    .exclude(rawid__isnull=True).exclude(rawid='').order_by('timestamp')
+
+    def refresh(self, limited=0):
+        """
+        Refresh stale accounts once.
+        :param limited: max count of accounts to refresh. 0 means no limitation.
+        :return: tuple of (count of refreshed accounts, count of changed accounts)
+        """
+        accounts = self.get_stale_accounts()
+        if limited > 0:
+            accounts = accounts[:limited]
+        accounts = list(accounts.only('id', 'rawid', 'account', 'platform',
+                                      *[field for field, attr in self.fields]))
+
+        count = changed = 0
+        for i in range(0, len(accounts), self.lookup_size):
+            batch = accounts[i:i + self.lookup_size]
+            changed += self._refresh_batch(batch)
+            count += len(batch)
+
+        log.info('%d accounts refreshed. %d changed.' % (count, changed))
+        return count, changed
+
+    def _refresh_batch(self, accounts):
+        try:
+            users = self.api.lookup_users(user_ids=[acc.rawid for acc in accounts])
+        except tweepy.TweepError as err:
+            if getattr(err, 'api_code', None) != 17:     # 17: no user matches
+                raise
+            users = []
+        users = dict((user.id_str, user) for user in users)
+
+        changed = 0
+        unchanged_ids = []
+        for acc in accounts:
+            user = users.get(acc.rawid)
+            if user is None:
+                # suspended or deleted. try again when stale next time.
+                log.debug('Account %s is not found.' % acc)
+                unchanged_ids.append(acc.id)
+                continue
+
+            update_fields = []
+            for field, attr in self.fields:
+                value = getattr(user, attr, None)
+                if field == 'utc_offset':
+                    value = value or 0
+                if getattr(acc, field) != value:
+                    setattr(acc, field, value)
+                    update_fields.append(field)
+
+            if update_fields:
+                update_fields.append('timestamp')
+                acc.save(update_fields=update_fields)
+                changed += 1
+                log.debug('Account %s refreshed. (%s)' % (acc, ', '.join(update_fields)))
+            else:
+                unchanged_ids.append(acc.id)
+
+        if unchanged_ids:
+            SocialAccount.objects.filter(id__in=unchanged_ids).update(timestamp=timezone.now())
+        return changed
+
+    def run(self, interval=3600, limited=0):
+        """
+        Refresh stale accounts on schedule until interrupted.
+        :param interval: seconds between refreshes. 0 means refresh once.
+        :param limited: max count of accounts per refresh. 0 means no limitation.
+        :return: N/A
+        """
+        while True:
+            start = time.time()
+            try:
+                self.refresh(limited=limited)
+            except tweepy.TweepError as err:
+                log.error('Fail to refresh accounts. %s' % err)
+            finally:
+                connection.close()      # don't hold DB connection while sleeping.
+
+            if interval <= 0:
+                break
+            wait = max(0, interval - (time.time() - start))
+            log.info('Next refresh in %d seconds. Rate limitation stats: %s' % (wait, self.api.scheduler.get_stats()))
+            time.sleep(wait)
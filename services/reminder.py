@@ -1,24 +1,554 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-from pyutils.timing_wheel import TimingWheel, IRemind
-from twido.models import Task
+"""
+Reminder daemon of task due.
+
+Tasks due within a window ahead are kept in a hierarchical timing wheel (keyed by task id).
+The window is refilled by range queries on Task.due as time goes. Tasks created, changed or deleted afterwards
+reach the wheel through the change log (TaskChange, written on saving/deleting tasks), consumed incrementally.
+Time reminded until is checkpointed in system config, so a restart only loads tasks due since the checkpoint.
+
+Profiles are partitioned into shards by profile id. Each shard is reminded by one worker at a time,
+holding a lease (ReminderLease) renewed periodically (also by a heartbeat thread while reminding takes long).
+Shards of dead workers are taken over when leases expire. Checkpoints are written only while the lease is owned.
+Reminding is at least once. (tasks reminded after the last checkpoint are reminded again on takeover/restart)
+Tasks failed to deliver are reminded again later, and the checkpoint is held back until they are delivered.
+"""
+from datetime import datetime
+from django.db import connection, connections, transaction, DatabaseError
+from django.db.models import F
 from django.utils import timezone
+from twido.models import Task, TaskChange, TaskStatus, Config, ReminderLease, UserProfile, List
+from .timing_wheel import TimingWheel
+from .delivery import Sink, Dispatcher
+import multiprocessing
+import os
+import re
+import socket
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def to_datetime(ts):
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+
+class LeaseLost(Exception):
+    pass
 
 
 class Reminder(object):
 
-    def __init__(self):
-        self._timer = TimingWheel()
+    checkpoint_interval = 60    # max seconds between checkpoints
+    batch_size = 500            # changes consumed / tasks loaded per query
+    retry_delay = 60            # seconds before reminding a task failed to deliver again. doubled per failure.
+    retry_limit = 10            # max count of reminding a task again. dropped afterwards.
+
+    def __init__(self, window=3600, tick=1.0, on_remind=None, shard=0, shards=1, name='reminder', is_owner=None):
+        """
+        :param window: seconds ahead tasks are loaded into the wheel.
+        :param tick: seconds of a tick of the wheel (the precision of reminding).
+        :param on_remind: function called with a list of due tasks. Default logs them.
+                          It may return a list of tasks failed to deliver, to be reminded again later.
+        :param shard: index of the shard of profiles reminded. (profile id % shards)
+        :param shards: count of shards.
+        :param name: prefix of the checkpoint name.
+        :param is_owner: function returning whether the shard is still owned. Checked before checkpointing.
+        """
+        self.shard = shard
+        self.shards = shards
+        self.checkpoint_name = self.get_checkpoint_name(name, shard, shards)
+        self.window = window
+        self.tick = tick
+        self.on_remind = on_remind or self.log_tasks
+        self.is_owner = is_owner
+        self._wheel = None
+        self._fired_until = None        # timestamp. tasks due before it are reminded.
+        self._loaded_until = None       # timestamp. tasks due before it are in the wheel.
+        self._checkpointed_at = 0
+        self._cursor = 0                # id of last consumed TaskChange
+        self._retries = {}              # task id -> (due, count of failures) of tasks failed to deliver
+        self._stats = {'loaded': 0, 'changes': 0, 'reminded': 0, 'failed': 0}
+
+    @staticmethod
+    def log_tasks(tasks):
+        for task in tasks:
+            log.info('Remind task %d (profile %d) due at %s.' % (task.id, task.profile_id, task.due))
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats['scheduled'] = len(self._wheel) if self._wheel is not None else 0
+        return stats
+
+    @staticmethod
+    def get_checkpoint_name(name, shard=0, shards=1):
+        if shards > 1:
+            return '%s.fired_until.%d-%d' % (name, shard, shards)
+        return '%s.fired_until' % name
+
+    @classmethod
+    def migrate_checkpoints(cls, name, shards):
+        """
+        Checkpoints are per shard. When count of shards changed, start checkpoints of the new shards from
+        the earliest checkpoint of the old shards (low-water mark), so tasks due meanwhile are still reminded.
+        (tasks reminded after it by some old shards are reminded again) Checkpoints of old shards are deleted.
+        """
+        names = [cls.get_checkpoint_name(name, shard, shards) for shard in range(shards)]
+        with transaction.atomic():
+            confs = Config.objects.filter(profile=UserProfile.get_sys_profile(),
+                                          name__regex=r'^%s(\.[0-9]+-[0-9]+)?$' % re.escape(name + '.fired_until'))
+            old = [conf for conf in confs if conf.name not in names]
+            if not old:
+                return
+            values = []
+            for conf in old:
+                try:
+                    values.append(float(conf.value))
+                except ValueError:
+                    log.warning('Invalid reminder checkpoint "%s" of %s. Ignored.' % (conf.value, conf.name))
+            if values:
+                for checkpoint_name in names:
+                    Config.objects.get_or_create(profile=UserProfile.get_sys_profile(), name=checkpoint_name,
+                                                 defaults={'value': '%.3f' % min(values)})
+            Config.objects.filter(id__in=[conf.id for conf in old]).delete()
+        log.warning('Reminder checkpoints of %s migrated to %d shards. Reminding since %s.' % (
+            ', '.join(conf.name for conf in old), shards, to_datetime(min(values)) if values else '-'))
+
+    def get_checkpoint(self):
+        # not cached. checkpoints are written by other worker processes.
+        conf = Config.objects.filter(profile=UserProfile.get_sys_profile(), name=self.checkpoint_name).first()
+        if conf is None:
+            return None
+        try:
+            return float(conf.value)
+        except ValueError:
+            log.warning('Invalid reminder checkpoint "%s". Ignored.' % conf.value)
+            return None
+
+    def set_checkpoint(self, ts):
+        """
+        :raise LeaseLost: if the shard is owned by another worker now. (which reminds since its own checkpoint)
+        """
+        if self.is_owner is not None and not self.is_owner():
+            raise LeaseLost('Lease of shard %d/%d is lost.' % (self.shard, self.shards))
+        Config.set_sys_conf(self.checkpoint_name, '%.3f' % ts)
+        self._checkpointed_at = ts
+
+    def get_reminded_until(self):
+        """
+        :return: timestamp to checkpoint. Before the due of any task waiting to be reminded again.
+        """
+        if not self._retries:
+            return self._fired_until
+        return min(self._fired_until, min(due for due, failures in self._retries.values()) - 1)
 
-    def start(self):
-        start = timezone.now()
-        end = start + timezone.timedelta(days=1)
+    def get_due_tasks(self, start, end):
+        """
+        :return: queryset of tasks to remind, due in (start, end].
+        """
+        return self._in_shard(Task.objects.filter(due__gt=to_datetime(start), due__lte=to_datetime(end)).exclude(
+            status__in=(TaskStatus.DONE, TaskStatus.CANCEL)), 'profile')
 
-        for task in Task.objects.filter(due__gte=start, due__lte=end):
-            self._timer.push(task.due, task)
-        self._timer.start()
-        print(self._timer._wheel)
+    def get_changes(self):
+        """
+        :return: queryset of unconsumed task changes.
+        """
+        return self._in_shard(TaskChange.objects.filter(id__gt=self._cursor), 'profile_id')
+
+    def _in_shard(self, queryset, field):
+        if self.shards <= 1:
+            return queryset
+        return queryset.annotate(shard=F(field) % self.shards).filter(shard=self.shard)
+
+    def start(self, now=None):
+        """
+        Load tasks due since the checkpoint (missed while stopped) to the window ahead.
+        """
+        now = time.time() if now is None else now
+        fired_until = self.get_checkpoint()
+        if fired_until is None or fired_until > now:
+            fired_until = now
+        self._fired_until = self._loaded_until = self._checkpointed_at = fired_until
+        self._wheel = TimingWheel(tick=self.tick, start=now)
+
+        # changes logged so far are reflected by loading tasks from now on.
+        last = self.get_changes().order_by('-id').values_list('id', flat=True).first()
+        if last:
+            self._cursor = last
+            while True:
+                ids = list(self._in_shard(TaskChange.objects.filter(id__lte=last), 'profile_id').values_list(
+                    'id', flat=True)[:self.batch_size])
+                if not ids:
+                    break
+                TaskChange.objects.filter(id__in=ids).delete()
+        self._refill(now)
+        log.info('Reminder of shard %d/%d started. %d tasks due since %s loaded.' % (
+            self.shard, self.shards, len(self._wheel), to_datetime(fired_until)))
 
     def stop(self):
-        self._timer.stop()
+        if self._fired_until is not None:
+            self.set_checkpoint(self.get_reminded_until())
+        log.info('Reminder of shard %d/%d stopped. Stats: %s' % (self.shard, self.shards, self.get_stats()))
+
+    def step(self, now=None):
+        """
+        Apply task changes, refill the window and remind due tasks.
+        :return: count of reminded tasks.
+        """
+        now = time.time() if now is None else now
+        self._apply_changes()
+        self._refill(now)
+        count = self._remind(now)
+        if count or now - self._checkpointed_at >= self.checkpoint_interval:
+            self.set_checkpoint(self.get_reminded_until())
+        return count
+
+    def _refill(self, now):
+        until = now + self.window
+        if until - self._loaded_until < self.window / 2.0:
+            return      # refill by half windows
+        count = 0
+        for task_id, due in self.get_due_tasks(self._loaded_until, until).values_list('id', 'due').iterator():
+            self._wheel.add(task_id, due.timestamp())
+            count += 1
+        self._loaded_until = until
+        self._stats['loaded'] += count
+        log.debug('%d tasks due by %s loaded.' % (count, to_datetime(until)))
+
+    def _apply_changes(self):
+        count = 0
+        while True:
+            changes = list(self.get_changes().order_by('id')[:self.batch_size])
+            for change in changes:
+                due = change.due.timestamp() if change.due else None
+                if change.task_id in self._retries:
+                    if change.is_scheduled() and due == self._retries[change.task_id][0]:
+                        continue    # still to be reminded again.
+                    self._retries.pop(change.task_id)
+                # tasks due after the window are loaded by refill.
+                # tasks due before reminded time are scheduled only if they were not due when changed.
+                if change.is_scheduled() and due <= self._loaded_until and \
+                        (due > self._fired_until or change.due >= change.created_at):
+                    self._wheel.add(change.task_id, due)
+                else:
+                    self._wheel.remove(change.task_id)
+            if changes:
+                self._cursor = changes[-1].id
+                count += len(changes)
+                TaskChange.objects.filter(id__in=[change.id for change in changes]).delete()
+            if len(changes) < self.batch_size:
+                break
+
+        if count:
+            self._stats['changes'] += count
+            log.debug('%d task changes applied.' % count)
+
+    def _remind(self, now):
+        expired = dict(self._wheel.advance(now))
+        ids = list(expired.keys())
+        tasks = []
+        for i in range(0, len(ids), self.batch_size):
+            try:
+                for task in Task.objects.filter(id__in=ids[i:i + self.batch_size]).exclude(
+                        status__in=(TaskStatus.DONE, TaskStatus.CANCEL)).select_related('profile'):
+                    due = self._retries[task.id][0] if task.id in self._retries else expired[task.id]
+                    # skip tasks changed without the log (such as by queryset update)
+                    if task.due and abs(task.due.timestamp() - due) < self.tick:
+                        tasks.append(task)
+            except DatabaseError:
+                # not reminded yet. remind them on next step.
+                for task_id in ids:
+                    self._wheel.add(task_id, expired[task_id])
+                raise
+
+        failed = []
+        if tasks:
+            failed = self.on_remind(tasks) or []    # all tasks of the tick at once. (to be batched by profile)
+        failed_ids = set(task.id for task in failed)
+        for task_id in ids:
+            if task_id in self._retries and task_id not in failed_ids:
+                self._retries.pop(task_id)          # delivered (or not to remind any more)
+        for task in failed:
+            self._retry(task, now)
+        self._fired_until = now
+        self._stats['reminded'] += len(tasks) - len(failed)
+        self._stats['failed'] += len(failed)
+        return len(tasks)
+
+    def _retry(self, task, now):
+        due, failures = self._retries.get(task.id, (task.due.timestamp(), 0))
+        if failures >= self.retry_limit:
+            self._retries.pop(task.id, None)
+            log.error('Fail to remind task %d (profile %d) %d times. Dropped.' % (task.id, task.profile_id,
+                                                                                   failures + 1))
+            return
+        self._retries[task.id] = (due, failures + 1)
+        self._wheel.add(task.id, now + self.retry_delay * 2 ** failures)
+
+
+class ReminderWorker(object):
+    """
+    Reminds shards preferred by the worker (shard % workers == index) and takes over shards of dead workers.
+    A shard taken over is handed back when its preferred worker claims it.
+    """
+
+    lease_seconds = 30      # renewed every 1/3 of it. dead worker's shards are taken after 2 of it.
+    stall_seconds = 600     # leases are not renewed by heartbeat if a step runs longer. (such as hung deliveries)
+
+    def __init__(self, index=0, workers=1, shards=0, window=3600, tick=1.0, on_remind=None, name='reminder'):
+        """
+        :param index: index of the worker. (0 ~ workers - 1)
+        :param workers: count of workers.
+        :param shards: count of shards. 0 means one per worker.
+        Other params are of Reminder.
+        """
+        self.index = index
+        self.workers = workers
+        self.shards = shards or workers
+        self.owner = '%s:%d:%d' % (socket.gethostname(), os.getpid(), index)
+        self.preferred = set(shard for shard in range(self.shards) if shard % workers == index)
+        self.window = window
+        self.tick = tick
+        self.on_remind = on_remind
+        self.name = name
+        self.reminders = {}     # shard -> Reminder of owned shards
+        self._running = False
+        self._stepped_at = 0    # time the current step started. 0 if not stepping.
+
+    def get_leases(self):
+        return ReminderLease.objects.filter(shards=self.shards)
+
+    def init_leases(self):
+        Reminder.migrate_checkpoints(self.name, self.shards)
+        for shard in range(self.shards):
+            ReminderLease.objects.get_or_create(shards=self.shards, shard=shard,
+                                                defaults={'expires': timezone.now()})
+
+    def update_leases(self, now):
+        """
+        Renew leases of owned shards. Acquire free preferred shards and expired shards of dead workers.
+        """
+        expires = to_datetime(now + self.lease_seconds)
+        for lease in self.get_leases():
+            shard = lease.shard
+            leases = ReminderLease.objects.filter(id=lease.id)
+            if shard in self.reminders:
+                if lease.owner != self.owner or not leases.filter(owner=self.owner).update(expires=expires):
+                    log.warning('Lease of shard %d/%d is lost to %s.' % (shard, self.shards, lease.owner or '-'))
+                    self.reminders.pop(shard)
+                elif lease.claimed_by and shard not in self.preferred:
+                    self.release(shard)     # hand over to the preferred worker.
+                continue
+
+            free = lease.owner == self.owner or not lease.owner or lease.expires < to_datetime(now)
+            if shard in self.preferred:
+                if not free:
+                    if lease.claimed_by != self.owner:
+                        leases.update(claimed_by=self.owner)
+                    continue
+            elif not free or lease.expires >= to_datetime(now - self.lease_seconds):
+                continue    # give the preferred worker a while to (re)start.
+
+            # compare and set. fails if another worker changed it after read.
+            if leases.filter(owner=lease.owner, expires=lease.expires).update(
+                    owner=self.owner, expires=expires, claimed_by=''):
+                self.acquire(shard, now)
+
+    def is_owner(self, shard):
+        return self.get_leases().filter(shard=shard, owner=self.owner, expires__gt=timezone.now()).exists()
+
+    def heartbeat(self, stop_event):
+        """
+        Renew leases of owned shards while steps (deliveries of reminders) run longer than leases.
+        Run in a thread (with its own DB connection) until stop_event set.
+        """
+        try:
+            while not stop_event.wait(self.lease_seconds / 3.0):
+                now = time.time()
+                if not self._stepped_at or now - self._stepped_at > self.stall_seconds:
+                    continue    # renewed by the run loop. or stalled, let other workers take over.
+                try:
+                    self.get_leases().filter(owner=self.owner, expires__gt=to_datetime(now)).update(
+                        expires=to_datetime(now + self.lease_seconds))
+                except DatabaseError as err:
+                    log.error('Fail to renew leases. %s' % err)
+                    connection.close()
+        finally:
+            connection.close()
+
+    def acquire(self, shard, now=None):
+        reminder = Reminder(window=self.window, tick=self.tick, on_remind=self.on_remind,
+                            shard=shard, shards=self.shards, name=self.name,
+                            is_owner=lambda: self.is_owner(shard))
+        reminder.start(now)
+        self.reminders[shard] = reminder
+        log.info('Shard %d/%d acquired by %s.' % (shard, self.shards, self.owner))
+
+    def release(self, shard):
+        reminder = self.reminders.pop(shard)
+        try:
+            reminder.stop()
+        except LeaseLost as err:
+            log.warning(err)
+            return
+        self.get_leases().filter(shard=shard, owner=self.owner).update(owner='', expires=timezone.now())
+        log.info('Shard %d/%d released by %s.' % (shard, self.shards, self.owner))
+
+    def run(self, interval=1.0, stop_event=None):
+        """
+        Remind until stopped or interrupted.
+        :param interval: seconds between steps (polls of task changes).
+        :param stop_event: multiprocessing.Event. Stop if set.
+        """
+        self.init_leases()
+        self._running = True
+        renew_at = 0
+        heartbeat_stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(heartbeat_stop, ), name='reminder-heartbeat')
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            while self._running and not (stop_event and stop_event.is_set()):
+                start = time.time()
+                try:
+                    if start >= renew_at:
+                        self.update_leases(start)
+                        renew_at = start + self.lease_seconds / 3.0
+                    self._stepped_at = start
+                    for shard, reminder in list(self.reminders.items()):
+                        try:
+                            reminder.step(start)
+                        except LeaseLost as err:
+                            log.warning(err)
+                            self.reminders.pop(shard)
+                except DatabaseError as err:
+                    log.error('Fail to remind. %s' % err)
+                    connection.close()      # reconnect on next step
+                finally:
+                    self._stepped_at = 0
+                time.sleep(max(0, interval - (time.time() - start)))
+        finally:
+            heartbeat_stop.set()
+            heartbeat.join()
+            for shard in list(self.reminders.keys()):
+                try:
+                    self.release(shard)
+                except DatabaseError as err:
+                    log.error('Fail to release shard %d/%d. %s' % (shard, self.shards, err))
+
+    def stop(self):
+        self._running = False
+
+
+def _run_worker(index, workers, shards, interval, stop_event, kwargs):
+    try:
+        ReminderWorker(index=index, workers=workers, shards=shards, **kwargs).run(interval, stop_event)
+    except KeyboardInterrupt:
+        pass
+
+
+def start_workers(workers, shards=0, interval=1.0, **kwargs):
+    """
+    Start reminder workers in processes.
+    :param kwargs: kwargs of ReminderWorker.
+    :return: tuple of (list of processes, stop event)
+    """
+    ctx = multiprocessing.get_context('fork')   # forked workers share the configured django.
+    connections.close_all()     # DB connections can't be shared with forked workers.
+    stop_event = ctx.Event()
+    processes = [ctx.Process(target=_run_worker, name='reminder-%d' % index,
+                             args=(index, workers, shards, interval, stop_event, kwargs))
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+    return processes, stop_event
+
+
+def stop_workers(processes, stop_event, timeout=30):
+    stop_event.set()
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+
+
+def run_workers(workers=1, shards=0, interval=1.0, **kwargs):
+    """
+    Run reminder workers until interrupted. Dead worker processes are restarted.
+    :param workers: count of worker processes. 1 means running in current process.
+    :param kwargs: kwargs of ReminderWorker.
+    """
+    if workers <= 1:
+        ReminderWorker(shards=shards, **kwargs).run(interval)
+        return
+
+    processes, stop_event = start_workers(workers, shards, interval, **kwargs)
+    try:
+        while True:
+            time.sleep(1)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    log.warning('Reminder worker %d exited (code %s). Restarted.' % (index, process.exitcode))
+                    processes[index] = multiprocessing.get_context('fork').Process(
+                        target=_run_worker, name=process.name,
+                        args=(index, workers, shards, interval, stop_event, kwargs))
+                    processes[index].start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(processes, stop_event)
+
+
+def benchmark(count=10000, workers=1, profiles=100, delay=1.0, lead=5.0):
+    """
+    Remind count tasks of bench profiles due at the same time by workers, and measure the throughput.
+    Run it against a stand-in database (such as a copy of the sqlite database) with no other reminder running.
+    :param count: count of bench tasks.
+    :param profiles: count of bench profiles the tasks belong to.
+    :param delay: milliseconds of (simulated) delivery to a profile.
+    :param lead: seconds from creating tasks to their due. Workers start meanwhile.
+    :return: dict of stats.
+    """
+    bench = []
+    for i in range(profiles):
+        profile, created = UserProfile.objects.get_or_create(
+            email='bench-%d%s' % (i, UserProfile.get_local_email_suffix()),
+            defaults={'username': 'bench-%d' % i, 'name': 'bench-%d' % i})
+        bench.append((profile, List.get_default(profile)))
+    profile_ids = [profile.id for profile, default_list in bench]
+
+    now = timezone.now()
+    due = to_datetime(time.time() + lead)
+    tasks = []
+    for i in range(count):
+        profile, default_list = bench[i % profiles]
+        tasks.append(Task(profile=profile, list=default_list, title='bench %d' % i, due=due, created_at=now))
+    Task.objects.bulk_create(tasks, batch_size=500)
+    log.info('%d bench tasks due at %s created.' % (count, due))
+
+    reminded = multiprocessing.get_context('fork').Value('i', 0)
+
+    class BenchSink(Sink):
+        def send(self, profile, tasks, **kwargs):
+            time.sleep(delay / 1000.0)
+            with reminded.get_lock():
+                reminded.value += len(tasks)
+
+    on_remind = Dispatcher(BenchSink(concurrency=8), workers=8)
+    processes, stop_event = start_workers(workers, interval=0.1, on_remind=on_remind, name='reminder-bench')
+    try:
+        timeout = time.time() + lead + 60 + count * delay / 1000.0
+        while reminded.value < count and time.time() < timeout:
+            time.sleep(0.05)
+        seconds = max(time.time() - due.timestamp(), 0.001)
+    finally:
+        stop_workers(processes, stop_event)
+        Task.objects.filter(profile_id__in=profile_ids, title__startswith='bench ').delete()
+        TaskChange.objects.filter(profile_id__in=profile_ids).delete()
+
+    return {'count': count, 'reminded': reminded.value, 'workers': workers, 'profiles': profiles,
+            'seconds': round(seconds, 3), 'rate': round(reminded.value / seconds, 1)}
@@ -1,18 +1,53 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
 from twido.models import SocialPlatform
+from social.twitter import TwitterClientManager
 from .storage import StorageType, StorageMixin
 from .import weibo
 
 
 import abc
+import re
 import tweepy
-import time
 import logging
 log = logging.getLogger(__name__)
 
 
+class FetchQuery(object):
+    """
+    A query fetched by spider. Each query keeps its own last id (since_id) checkpoint.
+    """
+
+    def __init__(self, name, endpoint='search', **kwargs):
+        """
+        :param name: query name. used as checkpoint key. (empty name means the legacy default checkpoint)
+        :param endpoint: API method name. (such as "search", "list_timeline")
+        :param kwargs: arguments to the API method.
+        """
+        self.name = name
+        self.endpoint = endpoint
+        self.kwargs = kwargs
+
+    @classmethod
+    def search(cls, q, lang=None):
+        kwargs = {'q': q}
+        if lang:
+            kwargs['lang'] = lang
+        name = re.sub(r'[^\w.-]+', '_', '%s_%s_%s' % ('search', q, lang or 'all')).strip('_')
+        return cls(name, 'search', **kwargs)
+
+    @classmethod
+    def list_timeline(cls, owner_screen_name, slug):
+        name = re.sub(r'[^\w.-]+', '_', '%s_%s_%s' % ('list', owner_screen_name, slug)).strip('_')
+        return cls(name, 'list_timeline', owner_screen_name=owner_screen_name, slug=slug)
+
+    def __str__(self):
+        return 'query(%s, %s, %s)' % (self.name or '<default>', self.endpoint, self.kwargs)
+
+
 class Spider(StorageMixin):
     """
     Abstract base class for all spiders.
@@ -20,7 +55,7 @@ class Spider(StorageMixin):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def fetch(self, test=False, limited=0):
+    def fetch(self, test=False, limited=0, queries=None, workers=1):
         """
         Fetch statuses
         :return: N/A
@@ -29,52 +64,104 @@ class Spider(StorageMixin):
 
 
 class TwitterSpider(Spider):
+
+    default_query = FetchQuery('', 'search', q='#todo', lang='en')
+    test_query = FetchQuery('', 'search', q='#todo list:samuelchen/tester', lang='en')
+
     def __init__(self, consumer_key, consumer_secret,
                  access_token, access_token_secret,
-                 storage=StorageType.DB, proxy=''):
-        super(TwitterSpider, self).__init__(storage=storage)
+                 storage=StorageType.DB, proxy='', batch_size=0):
+        super(TwitterSpider, self).__init__(storage=storage, batch_size=batch_size)
         self.auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-        self.auth.set_access_token(access_token, access_token_secret)
-        self.api = tweepy.API(self.auth, proxy=proxy or '')
-
-    def _limit_handled(self, cursor):
-        while True:
-            try:
-                yield cursor.next()
-            except tweepy.RateLimitError:
-                dur = 900   # 15 * 60
-                log.debug('Reaches rate limitation. Waiting %d seconds ...' % dur)
-                time.sleep(dur)
+        # calls are paced per endpoint by the scheduler shared with other twitter clients of the token.
+        self.api = TwitterClientManager.create_api_client(self.auth, access_token, access_token_secret,
+                                                          proxy=proxy or '', rate_limited=True)
 
     @property
     def social_platform(self):
         return SocialPlatform.TWITTER
 
-    def fetch(self, test=False, limited=0):
-        last_id = self.get_last_id()
+    def fetch(self, test=False, limited=0, queries=None, workers=1):
+        """
+        Fetch statuses of given queries.
+        :param test: only fetch test query if queries not given.
+        :param limited: max count to fetch per query. 0 means no limitation.
+        :param queries: list of FetchQuery. Default is the "#todo" search.
+        :param workers: count of queries running concurrently.
+        :return: N/A
+        """
+        if not queries:
+            queries = [self.test_query if test else self.default_query]
+
+        if workers > 1 and len(queries) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._fetch_query_in_thread, query, limited) for query in queries]
+                for future in futures:
+                    future.result()
+        else:
+            for query in queries:
+                self.fetch_query(query, limited=limited)
+
+        log.info('Rate limitation stats: %s' % self.api.scheduler.get_stats())
+
+    def _fetch_query_in_thread(self, query, limited=0):
+        try:
+            self.fetch_query(query, limited=limited)
+        except Exception as err:
+            log.exception('Fail to fetch %s. %s' % (query, err))
+            raise
+        finally:
+            # DB connections are thread local.
+            connection.close()
+
+    def fetch_query(self, query, limited=0):
+        """
+        Fetch statuses of a query since its checkpoint.
+        An interrupted fetch is resumed first.
+        :param query: FetchQuery instance
+        :param limited: max count to fetch. 0 means no limitation.
+        :return: N/A
+        """
+        checkpoint = self.get_checkpoint(query.name)
+        log.debug('%s %s' % (query, checkpoint))
+
+        if checkpoint.walking:
+            log.info('Resuming interrupted fetch of %s below %s' % (query, checkpoint.bottom))
+            if not self._walk(query, checkpoint, max_id=checkpoint.max_id, limited=limited):
+                return
+            checkpoint.complete()
+
+        if self._walk(query, checkpoint, limited=limited):
+            checkpoint.complete()
+        log.debug('%s saved' % checkpoint)
+
+    def _walk(self, query, checkpoint, max_id=None, limited=0):
+        """
+        Walk query results from the newest (or max_id) down to checkpoint since_id.
+        :return: True if the walk completed. False if stopped by limitation.
+        """
+        kwargs = dict(query.kwargs)
+        if max_id is not None:
+            kwargs['max_id'] = max_id
         count = 0
+        completed = True
 
-        log.debug('last_id = %s' % last_id)
-        cursor = tweepy.Cursor(self.api.search, lang='en',
-                               q='#todo list:samuelchen/tester' if test else '#todo',
-                               since_id=last_id).items()
-        for tweet in self._limit_handled(cursor):
+        cursor = tweepy.Cursor(getattr(self.api, query.endpoint), since_id=checkpoint.since_id, **kwargs).items()
+        for tweet in cursor:
             status = self.generate_status(tweet)
-            self.save_status(status)
-            # TODO: last_id logic needs to be clear. (tweepy result-set is not sorted)
-            if last_id < tweet.id_str:
-                last_id = tweet.id_str
+            self.save_status(status, checkpoint)
 
             if limited > 0:
                 count += 1
                 if count == limited:
+                    completed = False
                     break
 
             log.debug('\t%d [%s] *%d <%s> "%s" %s' % (tweet.id, tweet.created_at, tweet.favorite_count,
                                                       tweet.lang, tweet.user.screen_name, tweet.text))
 
-        self.save_last_id(last_id)
-        log.debug('last_id saved (%s)' % last_id)
+        self.flush_statuses()
+        return completed
 
     # def generate_status(self, raw_obj):
     #     """
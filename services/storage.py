@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-from twido.models import Config, RawStatus
+from twido.models import Config, RawStatus, UserProfile
+from django.db import transaction
 from django.utils.timezone import utc
 from django.db.utils import IntegrityError
 from pyutils.langutil import MutableEnum
 from twido.utils import parse_datetime
 
+from array import array
+from collections import OrderedDict
 import simplejson as json
+import bisect
+import mmap
 import os
 import abc
+import struct
+import threading
 import logging
 log = logging.getLogger(__name__)
 
@@ -24,20 +31,414 @@ StorageType.contains_DB = lambda t: StorageType.DB & t > 0
 StorageType.contains_NONE = lambda t: not(StorageType.contains_FILE(t) or StorageType.contains_DB(t))
 
 
+class Checkpoint(object):
+    """
+    Numeric high-water mark of fetched entry ids of a query.
+
+    Entries are fetched from the newest down to the high-water mark ("since_id"). During a fetch (walk),
+    the durable id range [bottom, top] is persisted along with each saved batch. So an interrupted walk
+    resumes below "bottom" instead of re-downloading. The high-water mark only moves forward (to "top")
+    when a walk completes.
+    """
+
+    def __init__(self, owner, query=''):
+        """
+        :param owner: StorageMixin instance which persists the checkpoint.
+        :param query: query name.
+        """
+        self._owner = owner
+        self.query = query
+        self.high, self.top, self.bottom = self.loads(owner.get_last_id(query))
+        self._dirty = False
+
+    @staticmethod
+    def loads(value):
+        """
+        :param value: persisted value. A legacy plain id or JSON of high/top/bottom.
+        :return: tuple of (high, top, bottom)
+        """
+        value = (value or '0').strip()
+        if value.startswith('{'):
+            d = json.loads(value)
+            return int(d['high']), d.get('top'), d.get('bottom')
+        return int(value), None, None
+
+    def dumps(self):
+        if self.top is None:
+            return str(self.high)
+        return json.dumps({'high': self.high, 'top': self.top, 'bottom': self.bottom})
+
+    @property
+    def since_id(self):
+        return self.high
+
+    @property
+    def walking(self):
+        """
+        :return: True if a walk is in progress (or was interrupted).
+        """
+        return self.top is not None
+
+    @property
+    def max_id(self):
+        """
+        :return: where an interrupted walk resumes. None if not walking.
+        """
+        return self.bottom - 1 if self.walking else None
+
+    def durable(self, ids):
+        """
+        Mark ids are saved durably. Persisted on next save().
+        """
+        ids = [i for i in map(int, ids) if i > self.high]
+        if not ids:
+            return
+        top, bottom = max(ids), min(ids)
+        self.top = top if self.top is None else max(self.top, top)
+        self.bottom = bottom if self.bottom is None else min(self.bottom, bottom)
+        self._dirty = True
+
+    def save(self):
+        if self._dirty:
+            self._owner.save_last_id(self.dumps(), self.query)
+            self._dirty = False
+
+    def complete(self):
+        """
+        Walk completed. Move high-water mark forward.
+        """
+        if self.walking:
+            self.high = max(self.high, self.top)
+            self.top = self.bottom = None
+            self._dirty = True
+        self.save()
+
+    def __str__(self):
+        return 'checkpoint(%s, %s)' % (self.query or '<default>', self.dumps())
+
+
+class SegmentLog(object):
+    """
+    Append-only log of statuses in rolling segment files.
+    Each record is a compact JSON line. A record is addressed by its offset (sequence number in the log).
+
+    Files in folder:
+        <base offset>.log   records. named by the offset of its first record.
+        <base offset>.idx   one fixed size entry (rawid, created_at, position, length) per record.
+        cursor.<name>       offset where a consumer (such as parser) continues reading.
+    """
+    index_entry = struct.Struct('>QqQI')     # rawid, created_at timestamp, position in segment, length
+    _name_format = '%020d'
+
+    def __init__(self, folder, segment_bytes=64 * 1024 * 1024):
+        """
+        :param folder: folder of segment files
+        :param segment_bytes: roll to a new segment when current one exceeds this size.
+        """
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._log_file = None
+        self._idx_file = None
+        self._base = 0
+        self._next_offset = 0
+
+    def get_segments(self):
+        """
+        :return: sorted list of segment base offsets
+        """
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(int(name[:-4]) for name in os.listdir(self.folder)
+                      if name.endswith('.log') and name[:-4].isdigit())
+
+    def get_segment_path(self, base, ext='.log'):
+        return os.path.join(self.folder, self._name_format % base + ext)
+
+    def _open(self):
+        os.makedirs(self.folder, exist_ok=True)
+        segments = self.get_segments()
+        base = segments[-1] if segments else 0
+        log_path, idx_path = self.get_segment_path(base), self.get_segment_path(base, '.idx')
+
+        # recover from an interrupted append. drop partial index entries and records not indexed.
+        entry_size = self.index_entry.size
+        log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        idx_size = os.path.getsize(idx_path) if os.path.exists(idx_path) else 0
+        count = idx_size // entry_size
+        end = 0
+        if count:
+            with open(idx_path, 'rb') as f:
+                while count:
+                    f.seek((count - 1) * entry_size)
+                    rawid, created_at, position, length = self.index_entry.unpack(f.read(entry_size))
+                    end = position + length + 1
+                    if end <= log_size:
+                        break
+                    count -= 1
+                    end = 0
+        self._log_file = open(log_path, 'ab')
+        self._log_file.truncate(end)
+        self._log_file.seek(end)
+        self._idx_file = open(idx_path, 'ab')
+        self._idx_file.truncate(count * entry_size)
+        self._idx_file.seek(count * entry_size)
+
+        self._base = base
+        self._next_offset = base + count
+
+    def _roll(self):
+        self.close()
+        self._base = self._next_offset
+        self._log_file = open(self.get_segment_path(self._base), 'ab')
+        self._idx_file = open(self.get_segment_path(self._base, '.idx'), 'ab')
+        log.debug('Rolled to segment %s' % (self._name_format % self._base))
+
+    def append(self, rawid, created_at, data):
+        """
+        Append a record.
+        :param rawid: numeric id of status
+        :param created_at: timestamp (seconds) of status
+        :param data: compact JSON bytes (must not contain new line)
+        :return: offset of the record
+        """
+        with self._lock:
+            if self._log_file is None:
+                self._open()
+            elif self._log_file.tell() >= self.segment_bytes:
+                self._roll()
+            position = self._log_file.tell()
+            self._log_file.write(data + b'\n')
+            self._idx_file.write(self.index_entry.pack(int(rawid), int(created_at), position, len(data)))
+            offset = self._next_offset
+            self._next_offset += 1
+            return offset
+
+    def sync(self):
+        """
+        Flush appended records to disk.
+        """
+        with self._lock:
+            for f in (self._log_file, self._idx_file):
+                if f is not None:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def close(self):
+        for f in (self._log_file, self._idx_file):
+            if f is not None:
+                f.close()
+        self._log_file = self._idx_file = None
+
+    def read(self, offset=0):
+        """
+        Read records sequentially.
+        :param offset: offset of the first record to read.
+        :return: generator of (offset, data bytes)
+        """
+        entry_size = self.index_entry.size
+        segments = self.get_segments()
+        for i, base in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1] <= offset:
+                continue
+            skip = max(offset - base, 0)
+            with open(self.get_segment_path(base, '.idx'), 'rb') as f:
+                f.seek(skip * entry_size)
+                entry = f.read(entry_size)
+            if len(entry) < entry_size:
+                continue
+            position = self.index_entry.unpack(entry)[2]
+
+            with open(self.get_segment_path(base), 'rb') as f:
+                f.seek(position)
+                current = base + skip
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break   # partial record being written
+                    yield current, line[:-1]
+                    current += 1
+
+    def get_cursor(self, name):
+        """
+        :return: offset where the consumer continues reading. 0 if never read.
+        """
+        try:
+            with open(os.path.join(self.folder, 'cursor.' + name), 'rt', encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def set_cursor(self, name, offset):
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, 'cursor.' + name)
+        with open(path + '.tmp', 'wt', encoding='utf-8') as f:
+            f.write(str(offset))
+        os.replace(path + '.tmp', path)
+
+
+class SegmentReader(object):
+    """
+    Random access reader of SegmentLog. Segments are memory mapped and records are
+    looked up by a sorted rawid index. Returned records are memoryview slices of the
+    mapped files (zero-copy). Release them before close().
+    """
+
+    def __init__(self, segment_log):
+        """
+        :param segment_log: SegmentLog instance to read.
+        """
+        self.segment_log = segment_log
+        self._maps = []         # list of mmap of segments
+        self._rawids = array('Q')
+        self._created = array('q')
+        self._segments = array('I')
+        self._positions = array('Q')
+        self._lengths = array('I')
+        self._signature = None  # segment and index sizes when opened
+
+    def get_signature(self):
+        """
+        :return: tuple of (base, segment size, index size) of each segment. Changes when records appended.
+        """
+        signature = []
+        for base in self.segment_log.get_segments():
+            sizes = []
+            for ext in ('.log', '.idx'):
+                try:
+                    sizes.append(os.path.getsize(self.segment_log.get_segment_path(base, ext)))
+                except OSError:
+                    sizes.append(0)
+            signature.append((base, sizes[0], sizes[1]))
+        return tuple(signature)
+
+    def refresh(self):
+        """
+        Reload only if segments changed since opened.
+        :return: True if reloaded.
+        """
+        signature = self.get_signature()
+        if signature == self._signature:
+            return False
+        self.open(signature)
+        return True
+
+    def open(self, signature=None):
+        """
+        Map segments and build index. Call again (or refresh()) to reload after more records appended.
+        """
+        self.close()
+        self._signature = signature if signature is not None else self.get_signature()
+        entries = []
+        maps = []
+        for base in self.segment_log.get_segments():
+            path = self.segment_log.get_segment_path(base)
+            if os.path.getsize(path) == 0:
+                continue
+            with open(path, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(self.segment_log.get_segment_path(base, '.idx'), 'rb') as f:
+                idx = f.read()
+            idx = idx[:len(idx) - len(idx) % SegmentLog.index_entry.size]
+            no = len(maps)
+            maps.append(m)
+            for rawid, created_at, position, length in SegmentLog.index_entry.iter_unpack(idx):
+                if position + length <= len(m):
+                    entries.append((rawid, created_at, no, position, length))
+
+        # sorted by rawid. a rawid appended more than once keeps the last record.
+        entries.sort(key=lambda e: e[0])
+        for i, e in enumerate(entries):
+            if i + 1 < len(entries) and entries[i + 1][0] == e[0]:
+                continue
+            self._rawids.append(e[0])
+            self._created.append(e[1])
+            self._segments.append(e[2])
+            self._positions.append(e[3])
+            self._lengths.append(e[4])
+        self._maps = maps
+        log.debug('%d records indexed in %d segments.' % (len(self._rawids), len(maps)))
+        return self
+
+    def close(self):
+        for m in self._maps:
+            m.close()
+        self._maps = []
+        self._signature = None
+        for a in (self._rawids, self._created, self._segments, self._positions, self._lengths):
+            del a[:]
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._rawids)
+
+    def _record(self, i):
+        pos = self._positions[i]
+        return memoryview(self._maps[self._segments[i]])[pos:pos + self._lengths[i]]
+
+    def get(self, rawid):
+        """
+        Point lookup.
+        :param rawid: status raw id
+        :return: memoryview of raw JSON bytes. None if not found.
+        """
+        rawid = int(rawid)
+        i = bisect.bisect_left(self._rawids, rawid)
+        if i < len(self._rawids) and self._rawids[i] == rawid:
+            return self._record(i)
+        return None
+
+    def scan(self, start_id=0, end_id=None):
+        """
+        Range scan by rawid.
+        :param start_id: inclusive
+        :param end_id: exclusive. None means no upper bound.
+        :return: generator of (rawid, memoryview of raw JSON bytes) ordered by rawid.
+        """
+        i = bisect.bisect_left(self._rawids, int(start_id))
+        j = len(self._rawids) if end_id is None else bisect.bisect_left(self._rawids, int(end_id))
+        for k in range(i, j):
+            yield self._rawids[k], self._record(k)
+
+    def scan_time(self, start, end):
+        """
+        Range scan by status created time.
+        :param start: inclusive timestamp (seconds)
+        :param end: exclusive timestamp (seconds)
+        :return: generator of (rawid, memoryview of raw JSON bytes) ordered by rawid.
+        """
+        for k, created_at in enumerate(self._created):
+            if start <= created_at < end:
+                yield self._rawids[k], self._record(k)
+
+
 class StorageMixin(object):
 
     __metaclass__ = abc.ABCMeta
 
     __data_folder = './data'    # storage folder if storage type is FILE
     __last_id_entry_prefix = 'last_id_'
+    __lookup_chunk_size = 500   # keep "IN (...)" under sqlite variables limit (999)
+    __segment_bytes = 64 * 1024 * 1024      # segment file size if storage type is FILE
 
-    def __init__(self, storage=StorageType.DB):
+    def __init__(self, storage=StorageType.DB, batch_size=0):
         """
         Initial with given storage type.
         :param storage:
+        :param batch_size: buffer statuses and insert them by batch into DB. 0 means save one by one.
         :return:
         """
         self.__storage = storage
+        self.__batch_size = batch_size
+        self.__batch = []       # list of (status, checkpoint)
+        self.__batch_lock = threading.RLock()     # statuses may be saved from multiple fetching threads
+        self.__checkpoints = {}
+        self.__segment_log = None
+        self.__segment_reader = None
         log.info('Storage Tpye : DB(%s) FILE(%s)' % (
             bool(StorageType.contains_DB(self.__storage)),
             bool(StorageType.contains_FILE(self.__storage))
@@ -47,52 +448,102 @@ class StorageMixin(object):
     def storage(self):
         return self.__storage
 
+    @property
+    def batch_size(self):
+        return self.__batch_size
+
     @property
     def data_folder(self):
         return self.__data_folder + '/' + self.social_platform
 
+    @property
+    def segment_log(self):
+        """
+        :return: SegmentLog of statuses if storage type is FILE
+        """
+        if self.__segment_log is None:
+            self.__segment_log = SegmentLog(self.data_folder, segment_bytes=self.__segment_bytes)
+        return self.__segment_log
+
+    def load_raw(self, rawid):
+        """
+        Load archived raw status from segment log. (such as for statuses whose raw is not kept in DB)
+        :param rawid: status raw id
+        :return: raw JSON str. None if not archived.
+        """
+        if self.__segment_reader is None:
+            self.__segment_reader = SegmentReader(self.segment_log).open()
+        data = self.__segment_reader.get(rawid)
+        if data is None and self.__segment_reader.refresh():
+            # appended after reader opened.
+            data = self.__segment_reader.get(rawid)
+        return bytes(data).decode('utf-8') if data is not None else None
+
     @property
     def last_id_config_key(self):
         return self.__last_id_entry_prefix + self.__class__.__name__
 
-    @staticmethod
-    def get_sub_folder(rawid):
-        return str(rawid)[:4]
+    def get_last_id_config_key(self, query=''):
+        """
+        :param query: query name. Each query has its own last id.
+        :return: config key (also file name) of last id.
+        """
+        if query:
+            return '%s_%s' % (self.last_id_config_key, query)
+        return self.last_id_config_key
+
+    def get_checkpoint(self, query=''):
+        """
+        :param query: query name. Default is the legacy (single query) one.
+        :return: Checkpoint instance of the query.
+        """
+        with self.__batch_lock:
+            if query not in self.__checkpoints:
+                self.__checkpoints[query] = Checkpoint(self, query)
+            return self.__checkpoints[query]
 
-    def save_last_id(self, last_id):
+    def save_last_id(self, last_id, query=''):
         """
         save last entry id
+        :param last_id:
+        :param query: query name. Default is the legacy (single query) one.
         :return:
         """
+        key = self.get_last_id_config_key(query)
 
         if StorageType.contains_DB(self.storage):
-            opt, created = Config.get_or_create_sys_conf(name=self.last_id_config_key)
-            opt.value = last_id
-            opt.save()
+            Config.set_sys_conf(key, last_id)
 
         elif StorageType.contains_FILE(self.storage):
-            path = os.path.join(self.data_folder, self.last_id_config_key)
-            with open(path, 'wt', encoding='utf-8') as f:
+            path = os.path.join(self.data_folder, key)
+            os.makedirs(self.data_folder, exist_ok=True)
+            with open(path + '.tmp', 'wt', encoding='utf-8') as f:
                 f.write(last_id)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)     # atomic
 
         else:
             raise ValueError('%s is not valid combination of storage types.' % self.storage)
 
-    def get_last_id(self):
+    def get_last_id(self, query=''):
         """
         obtain last fetched entry id
+        :param query: query name. Default is the legacy (single query) one.
         :return:
         """
+        key = self.get_last_id_config_key(query)
         last_id = '0'
         if StorageType.contains_DB(self.storage):
-            opt, created = Config.get_or_create_sys_conf(name=self.last_id_config_key)
+            # not cached. checkpoints are written by other fetching processes.
+            opt, created = Config.objects.get_or_create(profile=UserProfile.get_sys_profile(), name=key)
             if created:
                 opt.value = last_id
                 opt.save()
             else:
                 last_id = opt.value         # str
         elif StorageType.contains_FILE(self.storage):
-            path = os.path.join(self.data_folder, self.last_id_config_key)
+            path = os.path.join(self.data_folder, key)
             try:
                 with open(path, 'rt', encoding='utf-8') as f:
                     last_id = f.readline()  # str
@@ -104,10 +555,11 @@ class StorageMixin(object):
 
         return last_id
 
-    def save_status(self, status):
+    def save_status(self, status, checkpoint=None):
         """
         Save a status into database
         :param status: raw status object (RawStatus model entity)
+        :param checkpoint: Checkpoint advanced (on flush) once the status is durable.
         :return: N/A
         """
 
@@ -115,28 +567,89 @@ class StorageMixin(object):
             raise ValueError('%s is not valid combination of storage types.' % self.storage)
 
         if StorageType.contains_DB(self.storage):
-            try:
-                status.save()
-            except IntegrityError:
-                log.error('Entry "%s" is already existed.' % status.rawid)
+            if self.batch_size > 0:
+                with self.__batch_lock:
+                    self.__batch.append((status, checkpoint))
+                    if len(self.__batch) >= self.batch_size:
+                        self.flush_statuses()
+                # checkpoint advances when the batch is flushed.
+                checkpoint = None
+            else:
+                try:
+                    status.save()
+                except IntegrityError:
+                    log.error('Entry "%s" is already existed.' % status.rawid)
 
         if StorageType.contains_FILE(self.storage):
-            name = status.rawid
-            subfolder = self.get_sub_folder(name)
+            raw = status.raw
+            if '\n' in raw:
+                # one record per line. keep it compact.
+                raw = json.dumps(json.loads(raw), ensure_ascii=False, separators=(',', ':'))
+            self.segment_log.append(status.rawid, status.created_at.timestamp(), raw.encode('utf-8'))
+
+        if checkpoint is not None:
+            with self.__batch_lock:
+                checkpoint.durable([status.rawid])
+
+    def flush_statuses(self):
+        """
+        Insert buffered statuses into database with bulk_create in a single transaction.
+        Statuses with existing (or repeated) rawid are skipped without aborting the batch.
+        Checkpoints of flushed statuses are saved in the same transaction.
+        :return: count of inserted statuses
+        """
+        with self.__batch_lock:
+            batch, self.__batch = self.__batch, []
+            if StorageType.contains_FILE(self.storage):
+                self.segment_log.sync()
+            if StorageType.contains_DB(self.storage):
+                with transaction.atomic():
+                    count = self.__insert_statuses(batch) if batch else 0
+                    self.__save_checkpoints(batch)
+            else:
+                count = 0
+                self.__save_checkpoints(batch)
+            return count
+
+    def __save_checkpoints(self, batch):
+        checkpoint_ids = {}
+        for status, checkpoint in batch:
+            if checkpoint is not None:
+                checkpoint_ids.setdefault(checkpoint, []).append(status.rawid)
+        for checkpoint, ids in checkpoint_ids.items():
+            checkpoint.durable(ids)
+        for checkpoint in self.__checkpoints.values():
+            checkpoint.save()
+
+    def __insert_statuses(self, batch):
+        statuses = OrderedDict()
+        for status, checkpoint in batch:
+            statuses.setdefault(status.rawid, status)
+        rawids = list(statuses.keys())
 
-            path = os.path.join(self.data_folder, subfolder)
-            if not os.path.exists(path):
-                os.makedirs(path, exist_ok=True)
-                log.debug('Created folder %s' % path)
+        existed = set()
+        for i in range(0, len(rawids), self.__lookup_chunk_size):
+            existed.update(RawStatus.objects.filter(
+                rawid__in=rawids[i:i + self.__lookup_chunk_size]).values_list('rawid', flat=True))
+        new_statuses = [s for rawid, s in statuses.items() if rawid not in existed]
 
-            path = os.path.join(self.data_folder, subfolder, name) + '.json'
-            path_parsed = path + '.parsed'
+        try:
+            with transaction.atomic():
+                RawStatus.objects.bulk_create(new_statuses)
+            count = len(new_statuses)
+        except IntegrityError:
+            # inserted by another process meanwhile. fall back to one by one.
+            count = 0
+            for status in new_statuses:
+                try:
+                    with transaction.atomic():
+                        status.save()
+                    count += 1
+                except IntegrityError:
+                    log.error('Entry "%s" is already existed.' % status.rawid)
 
-            if os.path.exists(path_parsed):
-                path = path_parsed
-            with open(path, 'wt', encoding='utf-8') as f:
-                t = status.raw
-                f.write(t)
+        log.debug('Flushed %d statuses (%d skipped as existed).' % (count, len(batch) - count))
+        return count
 
     def generate_status(self, raw_obj):
         """
@@ -154,7 +667,7 @@ class StorageMixin(object):
             status.created_at = tweet.created_at.replace(tzinfo=utc)
         status.username = tweet.user.screen_name
         status.text = tweet.text
-        status.raw = json.dumps(tweet._json, ensure_ascii=False, indent=2)
+        status.raw = json.dumps(tweet._json, ensure_ascii=False, separators=(',', ':'))
         return status
 
     @abc.abstractproperty
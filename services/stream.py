@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Streaming (push) ingestion of statuses.
+
+A source pushes line-delimited status JSON into a bounded queue (blocks when full, as backpressure).
+The writer drains the queue and saves statuses into storage by batches.
+Sources are reconnected with jittered exponential backoff when disconnected.
+"""
+from pyutils.langutil import MutableEnum
+
+import abc
+import queue
+import random
+import threading
+import time
+import tweepy
+import simplejson as json
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class StreamError(Exception):
+    pass
+
+
+class StatusSource(object):
+    """
+    Abstract base class for status sources.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    finite = False      # a finite source ends ingestion when exhausted. Otherwise it's reconnected.
+
+    @abc.abstractmethod
+    def run(self, put):
+        """
+        Push raw status JSON lines until disconnected or exhausted.
+        :param put: function to push a line. It blocks if the queue is full.
+        :return: N/A
+        """
+        pass
+
+
+class ReplayFileSource(StatusSource):
+    """
+    Replay a local line-delimited JSON file. (such as a saved stream)
+    """
+    finite = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def run(self, put):
+        with open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    put(line)
+
+
+class _PushListener(tweepy.StreamListener):
+
+    def __init__(self, put):
+        super(_PushListener, self).__init__()
+        self.put = put
+        self.error = None
+
+    def on_data(self, raw_data):
+        self.put(raw_data)
+        return True
+
+    def on_error(self, status_code):
+        self.error = status_code
+        return False    # disconnect. reconnected by ingestor with backoff.
+
+
+class TwitterStreamSource(StatusSource):
+    """
+    Twitter streaming filter endpoint.
+    """
+
+    def __init__(self, auth, track=('#todo', ), languages=('en', )):
+        self.auth = auth
+        self.track = list(track)
+        self.languages = list(languages)
+
+    def run(self, put):
+        listener = _PushListener(put)
+        stream = tweepy.Stream(self.auth, listener)
+        stream.filter(track=self.track, languages=self.languages)
+        if listener.error:
+            raise StreamError('Stream disconnected with HTTP status %s' % listener.error)
+
+
+class StreamIngestor(object):
+    """
+    Ingest statuses from a source into spider storage.
+    """
+
+    checkpoint_name = 'stream'
+
+    def __init__(self, spider, source, queue_size=10000, flush_interval=1.0,
+                 backoff=1.0, max_backoff=320.0):
+        """
+        :param spider: Spider instance. Its storage (and batch size) is used to save statuses.
+        :param source: StatusSource instance
+        :param queue_size: max count of pending lines.
+        :param flush_interval: max seconds a status stays in the batch before flushed.
+        :param backoff: initial seconds to wait before reconnecting.
+        :param max_backoff: max seconds to wait before reconnecting.
+        """
+        self.spider = spider
+        self.source = source
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_interval = flush_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._stopped = threading.Event()
+        self._done = object()   # sentinel
+        self._error = None      # error ended a finite source
+
+    def stop(self):
+        self._stopped.set()
+
+    def _put(self, line):
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(line, timeout=1)
+                return
+            except queue.Full:
+                log.debug('Queue is full. Waiting writer ...')
+        raise StreamError('Ingestion stopped.')
+
+    def _read(self):
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                self.source.run(self._put)
+                failures = 0
+                if self.source.finite:
+                    break
+                log.warning('Source disconnected.')
+            except StreamError as err:
+                if self._stopped.is_set():
+                    break
+                log.warning(err)
+            except Exception as err:
+                if self.source.finite:
+                    # not retried. replaying again from the beginning would re-ingest duplicates.
+                    log.error('Source failed. %s' % err)
+                    self._error = err
+                    break
+                log.exception('Source failed. %s' % err)
+
+            failures += 1
+            wait = min(self.max_backoff, self.backoff * 2 ** (failures - 1)) * random.uniform(0.5, 1.5)
+            log.info('Reconnecting in %.1f seconds ...' % wait)
+            self._stopped.wait(wait)
+
+        self.queue.put(self._done)
+
+    def run(self, limited=0):
+        """
+        Ingest until the source is exhausted (finite), stopped or limited count reached.
+        :param limited: max count to ingest. 0 means no limitation.
+        :return: count of ingested statuses
+        :raise StreamError: if a finite source failed. (statuses ingested before it are saved)
+        """
+        reader = threading.Thread(target=self._read, name='stream-reader', daemon=True)
+        reader.start()
+
+        checkpoint = self.spider.get_checkpoint(self.checkpoint_name)
+        count = 0
+        flushed_at = time.time()
+        try:
+            while True:
+                try:
+                    line = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    line = None
+
+                if line is self._done:
+                    break
+
+                if line is not None:
+                    status_obj = self._load(line)
+                    if status_obj is not None:
+                        self.spider.save_status(self.spider.generate_status(status_obj), checkpoint)
+                        count += 1
+
+                if time.time() - flushed_at >= self.flush_interval:
+                    self._flush(checkpoint)
+                    flushed_at = time.time()
+
+                if 0 < limited <= count:
+                    break
+        finally:
+            self.stop()
+            self._flush(checkpoint)
+
+        if self._error is not None:
+            raise StreamError('Source failed after %d statuses ingested. %s' % (count, self._error))
+        log.info('Stream ingestion done. %d statuses ingested.' % count)
+        return count
+
+    def _flush(self, checkpoint):
+        self.spider.flush_statuses()
+        # pushed statuses have no gap to resume. move high-water mark forward directly.
+        checkpoint.complete()
+
+    @staticmethod
+    def _load(line):
+        """
+        :return: status object, or None if it's not a status (such as delete/limit notices).
+        """
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            log.warning('Invalid JSON line ignored. %s' % line[:100])
+            return None
+        if 'id_str' not in obj or 'user' not in obj:
+            log.debug('Non status message ignored. %s' % line[:100])
+            return None
+
+        status_obj = MutableEnum(obj)
+        status_obj.user = MutableEnum(obj['user'])
+        status_obj._json = obj
+        return status_obj
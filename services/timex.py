@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+HTTP client of the TIMEX3 parser endpoint.
+
+Connections are pooled and kept alive in a requests.Session. Connection errors and 5xx responses are
+retried with backoff. A circuit breaker fails fast while the endpoint keeps failing.
+
+Endpoint protocol:
+    single: GET <endpoint>?text=<text>&date=<date>
+            response is the TIMEX3 xml (or text starts with "error:")
+    batch:  POST <endpoint> with JSON body {"items": [{"text": <text>, "date": <date>}, ...]}
+            response is JSON {"results": [<TIMEX3 xml or "error:..." text>, ...]} in the same order.
+            Endpoints not supporting batch (404, 405, 501 or non-JSON response) fall back to single requests.
+"""
+from collections import deque
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    The endpoint is failing. Requests are rejected without connecting until the circuit resets.
+    """
+    pass
+
+
+def _create_retry(retries, backoff):
+    kwargs = dict(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                  status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+    try:
+        return Retry(allowed_methods=None, **kwargs)     # retry POST too. annotation is idempotent.
+    except TypeError:
+        return Retry(method_whitelist=False, **kwargs)   # urllib3 < 1.26
+
+
+class Timex3Client(object):
+
+    def __init__(self, endpoint, pool_size=10, timeout=30, retries=3, backoff=0.5,
+                 failure_threshold=5, reset_timeout=30):
+        """
+        :param endpoint: TIMEX3 parser endpoint URL
+        :param pool_size: max count of kept-alive connections. (should not be less than concurrent workers)
+        :param timeout: seconds to wait for connecting and for response.
+        :param retries: max retries on connection errors and 5xx responses.
+        :param backoff: backoff factor of retries. (waits backoff * 2 ^ (retry - 1) seconds)
+        :param failure_threshold: consecutive failures to open the circuit.
+        :param reset_timeout: seconds the circuit stays open before a trial request.
+        """
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=_create_retry(retries, backoff))
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.batch_supported = True
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0     # 0 means circuit is closed
+        self._trial = False     # a trial request is in flight while half-open
+
+        self._count = 0
+        self._errors = 0
+        self._rejected = 0
+        self._total = 0.0
+        self._latencies = deque(maxlen=1000)    # recent latencies for percentiles
+
+    def _before(self):
+        with self._lock:
+            if not self._opened_at:
+                return
+            if time.time() - self._opened_at < self.reset_timeout or self._trial:
+                self._rejected += 1
+                raise CircuitOpenError('Circuit of %s is open.' % self.endpoint)
+            self._trial = True      # half-open
+
+    def _after(self, succeed, latency):
+        with self._lock:
+            self._count += 1
+            self._total += latency
+            self._latencies.append(latency)
+            self._trial = False
+            if succeed:
+                self._failures = 0
+                if self._opened_at:
+                    log.info('Circuit of %s is closed.' % self.endpoint)
+                self._opened_at = 0
+            else:
+                self._errors += 1
+                self._failures += 1
+                if self._opened_at or self._failures >= self.failure_threshold:
+                    if not self._opened_at:
+                        log.warning('Circuit of %s is open. (%d failures)' % (self.endpoint, self._failures))
+                    self._opened_at = time.time()
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request through circuit breaker and record latency.
+        :return: requests.Response
+        """
+        self._before()
+        start = time.time()
+        try:
+            resp = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self._after(False, time.time() - start)
+            raise
+        self._after(resp.status_code < 500, time.time() - start)
+        return resp
+
+    def annotate(self, text, date):
+        """
+        Annotate text with TIMEX3 tags.
+        :param text: status text
+        :param date: base date (status created time)
+        :return: tuple of (TIMEX3 xml or error message, succeed)
+        """
+        payload = {
+            'text': text,
+            'date': date
+        }
+        r = self.request('GET', self.endpoint, params=payload)
+        log.debug('HTTP status code: %d' % r.status_code)
+
+        if r.text.startswith('error:'):
+            succeed = False
+        elif 200 <= r.status_code < 300:
+            succeed = True
+        else:
+            succeed = False
+        return r.text, succeed
+
+    def annotate_batch(self, items):
+        """
+        Annotate texts in one request. Falls back to single requests if endpoint does not support batch.
+        :param items: list of (text, date)
+        :return: list of (TIMEX3 xml or error message, succeed) in the order of items
+        """
+        if self.batch_supported and len(items) > 1:
+            payload = {'items': [{'text': text, 'date': date} for text, date in items]}
+            r = self.request('POST', self.endpoint, json=payload)
+            log.debug('HTTP status code: %d (batch of %d)' % (r.status_code, len(items)))
+
+            results = None
+            if r.status_code in (404, 405, 501):
+                results = None
+            elif 200 <= r.status_code < 300:
+                try:
+                    results = r.json()['results']
+                except (ValueError, KeyError, TypeError):
+                    results = None
+            else:
+                return [(r.text, False)] * len(items)
+
+            if results is None:
+                log.warning('Endpoint %s does not support batch. Use single requests.' % self.endpoint)
+                self.batch_supported = False
+            elif len(results) != len(items):
+                log.warning('Batch of %d items got %d results. Use single requests.' % (len(items), len(results)))
+            else:
+                return [(xml, not xml.startswith('error:')) for xml in results]
+
+        return [self.annotate(text, date) for text, date in items]
+
+    def get_stats(self):
+        """
+        :return: dict of request counters and latencies (seconds).
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                'requests': self._count,
+                'errors': self._errors,
+                'rejected': self._rejected,
+                'circuit': 'open' if self._opened_at else 'closed',
+                'avg': self._total / self._count if self._count else 0,
+            }
+        if latencies:
+            stats['min'] = latencies[0]
+            stats['max'] = latencies[-1]
+            stats['p50'] = latencies[len(latencies) // 2]
+            stats['p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return stats
+
+    def close(self):
+        self.session.close()
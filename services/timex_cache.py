@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Content addressed cache of TIMEX3 annotation results.
+
+Statuses sharing the same text (retweets, copy-paste spams) on the same day get the same annotation.
+Key is hash of (whitespace normalized text, day of base date, endpoint version).
+On a hit, base date in the cached xml is replaced with the date of the requesting status.
+"""
+from django.core.cache import caches
+from twido.utils import LRUCache, parse_datetime
+from xml.sax.saxutils import escape
+
+import abc
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class CacheType(object):
+    NONE = 'none'
+    MEMORY = 'memory'
+    SQLITE = 'sqlite'
+    DJANGO = 'django'
+
+    choices = (NONE, MEMORY, SQLITE, DJANGO)
+
+
+class AnnotationCache(object):
+    """
+    Abstract base class of annotation cache backends.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    _re_space = re.compile(r'\s+')
+    _re_date = re.compile(r'<DATE>.*?</DATE>', re.DOTALL)
+
+    def __init__(self, version=''):
+        """
+        :param version: endpoint version. Change it to invalidate results of a previous endpoint.
+        """
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, text, date):
+        """
+        :param text: status text
+        :param date: base date (status created time, string or datetime)
+        :return: cache key
+        """
+        if isinstance(date, str):
+            date = parse_datetime(date)
+        text = self._re_space.sub(' ', text or '').strip()
+        content = '\x00'.join((self.version, date.strftime('%Y-%m-%d'), text))
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get(self, text, date):
+        """
+        :return: TIMEX3 xml of text based on date, or None if missed.
+        """
+        xml = self._get(self.make_key(text, date))
+        if xml is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.rebase(xml, date)
+
+    @classmethod
+    def rebase(cls, xml, date):
+        """
+        :return: TIMEX3 xml whose base date is replaced with given date.
+        """
+        if not isinstance(date, str):
+            date = date.strftime('%a %b %d %H:%M:%S %z %Y')
+        return cls._re_date.sub(lambda m: '<DATE>%s</DATE>' % escape(date), xml, count=1)
+
+    def set(self, text, date, xml):
+        self._set(self.make_key(text, date), xml)
+
+    @abc.abstractmethod
+    def _get(self, key):
+        pass
+
+    @abc.abstractmethod
+    def _set(self, key, xml):
+        pass
+
+    def get_stats(self):
+        """
+        :return: dict of hits, misses and evictions.
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / total if total else 0,
+        }
+
+    def close(self):
+        pass
+
+
+class MemoryAnnotationCache(AnnotationCache):
+    """
+    In-process LRU cache. Results are lost when process exits.
+    """
+
+    def __init__(self, size=10000, version=''):
+        super(MemoryAnnotationCache, self).__init__(version)
+        self._cache = LRUCache(size)
+
+    def _get(self, key):
+        return self._cache.get(key)
+
+    def _set(self, key, xml):
+        self._cache.set(key, xml)
+
+    def get_stats(self):
+        self.evictions = self._cache.evictions
+        stats = super(MemoryAnnotationCache, self).get_stats()
+        stats['size'] = len(self._cache)
+        return stats
+
+
+class SqliteAnnotationCache(AnnotationCache):
+    """
+    Cache in a sqlite file. Results are kept across parse runs.
+    Least recently used entries are evicted when entries exceed size.
+    """
+
+    def __init__(self, path='./data/timex_cache.sqlite3', size=100000, version=''):
+        super(SqliteAnnotationCache, self).__init__(version)
+        self.size = size
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS annotation '
+                           '(key TEXT PRIMARY KEY, xml TEXT NOT NULL, used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS annotation_used ON annotation (used)')
+        self._count = self._conn.execute('SELECT COUNT(*) FROM annotation').fetchone()[0]
+
+    def _get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT xml FROM annotation WHERE key = ?', (key, )).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE annotation SET used = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def _set(self, key, xml):
+        with self._lock:
+            cur = self._conn.execute('INSERT OR REPLACE INTO annotation (key, xml, used) VALUES (?, ?, ?)',
+                                     (key, xml, time.time()))
+            self._count += cur.rowcount     # over counted if replaced. recounted before eviction.
+            if self._count > self.size * 1.1:
+                self._count = self._conn.execute('SELECT COUNT(*) FROM annotation').fetchone()[0]
+            if self._count > self.size * 1.1:
+                # evict by bulk to amortize the cost.
+                count = self._count - self.size
+                self._conn.execute('DELETE FROM annotation WHERE key IN '
+                                   '(SELECT key FROM annotation ORDER BY used LIMIT ?)', (count, ))
+                self.evictions += count
+                self._count -= count
+
+    def get_stats(self):
+        stats = super(SqliteAnnotationCache, self).get_stats()
+        stats['size'] = self._count
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DjangoAnnotationCache(AnnotationCache):
+    """
+    Cache in a Django cache backend (settings.CACHES). Size is bounded by the backend (such as MAX_ENTRIES).
+    """
+
+    _key_prefix = 'timex3:'
+
+    def __init__(self, alias='default', timeout=None, version=''):
+        """
+        :param alias: alias of cache in settings.CACHES
+        :param timeout: seconds to keep results. None means backend default.
+        """
+        super(DjangoAnnotationCache, self).__init__(version)
+        self._cache = caches[alias]
+        self.timeout = timeout
+
+    def _get(self, key):
+        return self._cache.get(self._key_prefix + key)
+
+    def _set(self, key, xml):
+        if self.timeout is None:
+            self._cache.set(self._key_prefix + key, xml)
+        else:
+            self._cache.set(self._key_prefix + key, xml, self.timeout)
+
+
+def create_cache(cache_type, size=10000, version='', path='./data/timex_cache.sqlite3'):
+    """
+    :param cache_type: one of CacheType
+    :return: AnnotationCache instance, or None if cache_type is CacheType.NONE
+    """
+    if cache_type == CacheType.MEMORY:
+        return MemoryAnnotationCache(size, version=version)
+    elif cache_type == CacheType.SQLITE:
+        return SqliteAnnotationCache(path, size, version=version)
+    elif cache_type == CacheType.DJANGO:
+        return DjangoAnnotationCache(version=version)
+    elif not cache_type or cache_type == CacheType.NONE:
+        return None
+    else:
+        raise ValueError('Unsupported cache type %s' % cache_type)
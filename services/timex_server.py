@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Local stand-in of the TIMEX3 parser endpoint for testing and benchmarking.
+
+It implements both single (GET) and batch (POST) protocols of services.timex.Timex3Client with a tiny
+rule based tagger. It only recognizes a few common expressions. (today, tomorrow, weekdays, 7pm, daily, ...)
+
+Usage:
+    python -m services.timex_server --port 8088 --delay 20
+    python -m services.timex_server --bench 1000 --batch-size 50 --workers 4 --delay 20
+"""
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape, quoteattr
+import argparse
+import json
+import re
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+_date_format = '%a %b %d %H:%M:%S %z %Y'
+_weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+_re_timex = re.compile(r'\b(?:(?P<day>today|tonight|tomorrow|yesterday)'
+                       r'|(?P<weekday>(?:next\s+)?(?:%s))'
+                       r'|(?P<time>(?:1[0-2]|0?[1-9])(?::[0-5]\d)?\s?(?:am|pm))'
+                       r'|(?P<set>daily|every\s+day|weekly|every\s+week)'
+                       r'|(?P<next>next\s+(?:week|month|year)))\b' % '|'.join(_weekdays), re.IGNORECASE)
+
+
+def _value(m, base):
+    """
+    :return: tuple of (TIMEX3 type, value) of matched expression
+    """
+    text = m.group(0).lower()
+    if m.group('day'):
+        delta = {'today': 0, 'tonight': 0, 'tomorrow': 1, 'yesterday': -1}[text]
+        value = (base + timedelta(days=delta)).strftime('%Y-%m-%d')
+        return ('TIME', value + 'TNI') if text == 'tonight' else ('DATE', value)
+    if m.group('weekday'):
+        days = (_weekdays.index(text.split()[-1]) - base.weekday()) % 7 or 7
+        if text.startswith('next'):
+            days += 7 if days < 7 else 0
+        return 'DATE', (base + timedelta(days=days)).strftime('%Y-%m-%d')
+    if m.group('time'):
+        t = re.match(r'(\d+)(?::(\d+))?\s?(am|pm)', text)
+        hour = int(t.group(1)) % 12 + (12 if t.group(3) == 'pm' else 0)
+        return 'TIME', '%sT%02d:%s' % (base.strftime('%Y-%m-%d'), hour, t.group(2) or '00')
+    if m.group('set'):
+        return 'SET', 'P1W' if 'week' in text else 'P1D'
+    unit = text.split()[-1]
+    if unit == 'week':
+        return 'DATE', (base + timedelta(days=7)).strftime('%G-W%V')
+    if unit == 'month':
+        return 'DATE', '%04d-%02d' % (base.year + base.month // 12, base.month % 12 + 1)
+    return 'DATE', '%04d' % (base.year + 1)
+
+
+def annotate(text, date):
+    """
+    :param text: text to annotate
+    :param date: base date in format of Twitter created_at
+    :return: TIMEX3 xml
+    """
+    try:
+        base = datetime.strptime(date, _date_format)
+    except (TypeError, ValueError):
+        raise ValueError('invalid date %s' % date)
+
+    sb = []
+    pos = 0
+    for i, m in enumerate(_re_timex.finditer(text), 1):
+        tp, value = _value(m, base)
+        sb.append(escape(text[pos:m.start()]))
+        sb.append('<TIMEX3 tid="t%d" type="%s" value=%s>%s</TIMEX3>' % (i, tp, quoteattr(value), escape(m.group(0))))
+        pos = m.end()
+    sb.append(escape(text[pos:]))
+    return '<?xml version="1.0"?>\n<root>\n<DATE>%s</DATE>\n<TEXT>%s</TEXT>\n</root>\n' % (escape(date), ''.join(sb))
+
+
+def _annotate_or_error(text, date):
+    try:
+        return annotate(text or '', date)
+    except ValueError as err:
+        return 'error: %s' % err
+
+
+class Timex3RequestHandler(BaseHTTPRequestHandler):
+
+    delay = 0.0     # seconds of simulated fixed overhead per request
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        text = params.get('text', [''])[0]
+        date = params.get('date', [''])[0]
+        time.sleep(self.delay)
+        self._send(200, 'application/xml', _annotate_or_error(text, date))
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            items = body['items']
+        except (ValueError, KeyError, TypeError) as err:
+            self._send(400, 'text/plain', 'error: %s' % err)
+            return
+        time.sleep(self.delay)
+        results = [_annotate_or_error(item.get('text'), item.get('date')) for item in items]
+        self._send(200, 'application/json', json.dumps({'results': results}))
+
+    def _send(self, code, content_type, content):
+        data = content.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', '%s; charset=utf-8' % content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class Timex3Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def create_server(host='127.0.0.1', port=8088, delay=0.0):
+    """
+    :param delay: seconds of simulated fixed overhead per request.
+    :return: Timex3Server instance. Call serve_forever() to run.
+    """
+    # HTTP/1.1 keeps connections alive, as a real endpoint does.
+    handler = type('Handler', (Timex3RequestHandler, ), {'delay': delay, 'protocol_version': 'HTTP/1.1'})
+    return Timex3Server((host, port), handler)
+
+
+def benchmark(endpoint, count=1000, batch_size=50, workers=4):
+    """
+    Compare throughput of single requests and batch requests.
+    :return: dict of statuses per second by mode
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from .timex import Timex3Client
+
+    date = datetime.utcnow().strftime('%a %b %d %H:%M:%S +0000 %Y')
+    items = [('#todo call mom tomorrow at 7pm #%d' % i, date) for i in range(count)]
+    chunks = [items[i:i + batch_size] for i in range(0, count, batch_size)]
+    client = Timex3Client(endpoint, pool_size=workers)
+
+    stats = {}
+    for mode, tasks, fn in (('single', items, lambda item: client.annotate(*item)),
+                            ('batch', chunks, client.annotate_batch)):
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(fn, tasks))
+        stats[mode] = count / (time.time() - start)
+    client.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in of TIMEX3 parser endpoint.')
+    parser.add_argument('--host', default='127.0.0.1', help='Default is 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8088, help='Default is 8088. 0 means any free port.')
+    parser.add_argument('--delay', type=float, default=0, help='Simulated overhead per request (ms). Default is 0.')
+    parser.add_argument('--bench', type=int, default=0, metavar='COUNT',
+                        help='Benchmark single and batch requests of COUNT statuses against this server.')
+    parser.add_argument('--batch-size', type=int, default=50, help='Batch size of benchmark. Default is 50.')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent requests of benchmark. Default is 4.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = create_server(args.host, args.port, args.delay / 1000.0)
+    endpoint = 'http://%s:%d/' % server.server_address[:2]
+
+    if not args.bench:
+        log.info('Serving TIMEX3 endpoint at %s' % endpoint)
+        server.serve_forever()
+        return
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stats = benchmark(endpoint, args.bench, args.batch_size, args.workers)
+    for mode, rate in sorted(stats.items()):
+        log.info('%-6s: %.1f statuses/second' % (mode, rate))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Hierarchical timing wheel.
+
+Each level is a ring of slots. A slot of level N spans all slots of level N-1.
+Entries are placed in the lowest level covering their delay and cascaded down when the clock reaches their slot.
+Entries beyond the top level are kept in an overflow heap and moved into the wheel when they come in range,
+so the horizon is arbitrary.
+Adding, replacing and removing an entry is O(1). The wheel is driven by advance() (no timer thread).
+"""
+import heapq
+import itertools
+
+
+class TimingWheel(object):
+
+    def __init__(self, tick=1.0, levels=(60, 60, 24), start=0):
+        """
+        :param tick: seconds of a slot of the lowest level.
+        :param levels: count of slots of each level, the lowest first. Default is seconds, minutes and hours.
+        :param start: timestamp (seconds) the wheel starts at.
+        """
+        self.tick = float(tick)
+        self._slots = tuple(levels)
+        self._spans = [1]       # ticks per slot of each level, plus ticks of the whole top level.
+        for slots in self._slots:
+            self._spans.append(self._spans[-1] * slots)
+        self._wheels = [[{} for _ in range(slots)] for slots in self._slots]
+        self._overflow = []     # heap of (tick, seq, key)
+        self._seq = itertools.count()
+        self._ready = {}        # key -> when. due before the current tick when added.
+        self._entries = {}      # key -> (when, tick, location)
+        self._current = self.to_tick(start)
+
+    def to_tick(self, when):
+        return int(when // self.tick)
+
+    def _expiry_tick(self, when):
+        return -int(-when // self.tick)     # ceiling. never expires before when.
+
+    @property
+    def current(self):
+        """
+        :return: timestamp of the current tick.
+        """
+        return self._current * self.tick
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        :return: timestamp the key is scheduled at, or None.
+        """
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def add(self, key, when):
+        """
+        Schedule key at timestamp when. Replaces the existing schedule of the key.
+        Key expires on the first advance() to a time not earlier than when.
+        """
+        self.remove(key)
+        tick = self._expiry_tick(when)
+        if tick <= self._current:
+            self._ready[key] = when
+            self._entries[key] = (when, tick, None)
+        else:
+            self._place(key, when, tick)
+
+    def remove(self, key):
+        """
+        :return: timestamp the removed key was scheduled at, or None.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        when, tick, location = entry
+        if location is None:
+            del self._ready[key]
+        elif location != 'overflow':
+            level, slot = location
+            del self._wheels[level][slot][key]
+        # entries in overflow heap are dropped lazily.
+        return when
+
+    def clear(self):
+        for wheel in self._wheels:
+            for slot in wheel:
+                slot.clear()
+        self._overflow = []
+        self._ready.clear()
+        self._entries.clear()
+
+    def _place(self, key, when, tick):
+        delay = tick - self._current
+        for level, slots in enumerate(self._slots):
+            if delay < self._spans[level + 1]:
+                slot = (tick // self._spans[level]) % slots
+                self._wheels[level][slot][key] = when
+                self._entries[key] = (when, tick, (level, slot))
+                return
+        heapq.heappush(self._overflow, (tick, next(self._seq), key))
+        self._entries[key] = (when, tick, 'overflow')
+
+    def _cascade(self, level):
+        slot = (self._current // self._spans[level]) % self._slots[level]
+        entries = self._wheels[level][slot]
+        if entries:
+            self._wheels[level][slot] = {}
+            for key, when in entries.items():
+                self._place(key, when, self._entries[key][1])
+
+    def _pull_overflow(self):
+        top = self._spans[-1]
+        while self._overflow and self._overflow[0][0] - self._current < top:
+            tick, seq, key = heapq.heappop(self._overflow)
+            entry = self._entries.get(key)
+            if entry and entry[2] == 'overflow' and entry[1] == tick:
+                self._place(key, entry[0], tick)
+
+    def next_expiry(self):
+        """
+        :return: timestamp of the earliest tick which may have expired entries, or None if empty.
+        Entries are cascaded on slot boundaries, so it may be earlier than the actual expiry (never later).
+        """
+        tick = self._next_tick()
+        return None if tick is None else tick * self.tick
+
+    def _next_tick(self):
+        if self._ready:
+            return self._current
+        ticks = []
+        for level, wheel in enumerate(self._wheels):
+            span = self._spans[level]
+            base = self._current // span
+            for i in range(1, self._slots[level] + 1):
+                if wheel[(base + i) % self._slots[level]]:
+                    ticks.append((base + i) * span)
+                    break
+        if self._overflow:
+            # pulled into the wheel on a slot boundary of the top level at the latest.
+            span = self._spans[-2]
+            ticks.append(self._overflow[0][0] // span * span)
+        return min(ticks) if ticks else None
+
+    def advance(self, now):
+        """
+        Move clock to timestamp now.
+        :return: list of (key, when) expired, in the order of ticks.
+        """
+        expired = list(self._ready.items())
+        for key in self._ready:
+            del self._entries[key]
+        self._ready.clear()
+
+        target = self.to_tick(now)
+        while self._current < target:
+            if not self._entries:
+                self._current = target      # nothing to expire. jump.
+                break
+            next_tick = self._next_tick()
+            if next_tick is not None and next_tick > self._current + 1:
+                # skip empty ticks up to the next cascading or expiry (or target)
+                self._current = min(next_tick, target) - 1
+            self._current += 1
+
+            # cascade the higher levels first, so entries due on this tick reach level 0.
+            if self._overflow and self._current % self._spans[-2] == 0:
+                self._pull_overflow()
+            for level in range(len(self._slots) - 1, 0, -1):
+                if self._current % self._spans[level] == 0:
+                    self._cascade(level)
+
+            slot = self._wheels[0][self._current % self._slots[0]]
+            if slot:
+                self._wheels[0][self._current % self._slots[0]] = {}
+                for key, when in slot.items():
+                    del self._entries[key]
+                    expired.append((key, when))
+        return expired
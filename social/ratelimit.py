@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Rate limitation scheduler for social platform APIs.
+
+Calls are paced per endpoint by a token bucket. The bucket is sized by a configured budget
+(calls per window) and re-calibrated by the rate limit status reported by the API
+(such as Twitter "x-rate-limit-remaining" / "x-rate-limit-reset" headers).
+When an endpoint is exhausted, callers sleep exactly until its window resets.
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class _Window(object):
+    """
+    Token bucket of an endpoint.
+    """
+
+    def __init__(self, budget, window, now):
+        self.capacity = budget
+        self.default_rate = float(budget) / window
+        self.rate = self.default_rate
+        self.tokens = float(budget)
+        self.updated = now
+        self.resets_at = 0      # window reset time reported by API. 0 means unknown.
+        self.calls = 0
+        self.throttled_seconds = 0.0
+
+    def refill(self, now):
+        if self.resets_at and now >= self.resets_at:
+            # new window begins. full budget available again.
+            self.tokens = float(self.capacity)
+            self.rate = self.default_rate
+            self.resets_at = 0
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimitScheduler(object):
+    """
+    Thread safe scheduler shared by API clients.
+
+    Usage:
+        with scheduler.throttle('search'):
+            resp = api.search(q='#todo')
+            scheduler.update('search', resp.headers)
+    """
+
+    def __init__(self, budget=180, window=900, clock=time.time, sleep=time.sleep):
+        """
+        :param budget: default calls allowed per window per endpoint.
+        :param window: rate limit window in seconds. (Twitter is 15 minutes)
+        :param clock: function returns current time in seconds.
+        :param sleep: function to sleep given seconds.
+        """
+        self._budget = budget
+        self._window = window
+        self._budgets = {}      # endpoint -> budget overrides
+        self._windows = {}      # endpoint -> _Window
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+        self._started = clock()
+        self._active = 0        # calls waiting or in flight
+        self._idle_since = self._started
+        self._calls = 0
+        self._throttled_seconds = 0.0
+        self._idle_seconds = 0.0
+
+    @property
+    def window(self):
+        return self._window
+
+    def set_budget(self, endpoint, budget):
+        """
+        Configure budget (calls per window) of an endpoint.
+        """
+        with self._lock:
+            self._budgets[endpoint] = budget
+            self._windows.pop(endpoint, None)
+
+    def _get_window(self, endpoint, now):
+        w = self._windows.get(endpoint)
+        if w is None:
+            w = self._windows[endpoint] = _Window(self._budgets.get(endpoint, self._budget), self._window, now)
+        return w
+
+    def acquire(self, endpoint):
+        """
+        Block until a call to the endpoint is allowed.
+        :param endpoint: endpoint name
+        :return: seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                w = self._get_window(endpoint, now)
+                w.refill(now)
+                if w.tokens >= 1:
+                    w.tokens -= 1
+                    w.calls += 1
+                    w.throttled_seconds += waited
+                    self._calls += 1
+                    self._throttled_seconds += waited
+                    return waited
+
+                if w.resets_at:
+                    wait = w.resets_at - now
+                elif w.rate > 0:
+                    wait = (1 - w.tokens) / w.rate
+                else:
+                    wait = self._window
+
+            wait = max(wait, 0.01)
+            if wait > 60:
+                log.info('Endpoint "%s" is rate limited. Waiting %d seconds ...' % (endpoint, wait))
+            self._sleep(wait)
+            waited += wait
+
+    def update(self, endpoint, headers):
+        """
+        Re-calibrate endpoint bucket by rate limit status reported by API.
+        :param endpoint: endpoint name
+        :param headers: response headers (contains x-rate-limit-limit/remaining/reset)
+        :return: N/A
+        """
+        if not headers:
+            return
+        remaining = headers.get('x-rate-limit-remaining')
+        resets_at = headers.get('x-rate-limit-reset')
+        if remaining is None or resets_at is None:
+            return
+        limit = headers.get('x-rate-limit-limit')
+        remaining = int(remaining)
+        resets_at = float(resets_at)
+
+        with self._lock:
+            now = self._clock()
+            w = self._get_window(endpoint, now)
+            if limit:
+                w.capacity = int(limit)
+                w.default_rate = float(w.capacity) / self._window
+            w.refill(now)
+            if resets_at > now:
+                w.tokens = min(w.tokens, remaining)
+                w.resets_at = resets_at
+                # spread the rest of remaining calls until the window resets.
+                w.rate = (remaining - w.tokens) / (resets_at - now)
+
+    def limited(self, endpoint, headers=None):
+        """
+        Tell scheduler the endpoint is rate limited (API rejected the call).
+        Following calls wait until the reported reset time, or a whole window if unknown.
+        """
+        self.update(endpoint, headers)
+        with self._lock:
+            now = self._clock()
+            w = self._get_window(endpoint, now)
+            w.tokens = 0.0
+            w.rate = 0.0
+            if w.resets_at <= now:
+                w.resets_at = now + self._window
+
+    @contextmanager
+    def throttle(self, endpoint):
+        """
+        Context of a call to endpoint. Waits for allowance before entering.
+        """
+        self._enter()
+        try:
+            self.acquire(endpoint)
+            yield
+        finally:
+            self._leave()
+
+    def _enter(self):
+        with self._lock:
+            if self._active == 0:
+                self._idle_seconds += self._clock() - self._idle_since
+            self._active += 1
+
+    def _leave(self):
+        with self._lock:
+            self._active -= 1
+            if self._active == 0:
+                self._idle_since = self._clock()
+
+    def get_stats(self):
+        """
+        :return: dict of counters. idle means no call is waiting or in flight.
+        """
+        with self._lock:
+            now = self._clock()
+            idle = self._idle_seconds
+            if self._active == 0:
+                idle += now - self._idle_since
+            return {
+                'elapsed': now - self._started,
+                'calls': self._calls,
+                'throttled_seconds': self._throttled_seconds,
+                'idle_seconds': idle,
+                'endpoints': dict((name, {'calls': w.calls, 'throttled_seconds': w.throttled_seconds})
+                                  for name, w in self._windows.items()),
+            }
@@ -4,27 +4,109 @@
 """
 Twitter related
 """
+import functools
+import threading
 import tweepy
 from requests_oauthlib import OAuth1Session
+from .ratelimit import RateLimitScheduler
 
 
 class TwitterClientManager(object):
 
+    # access token -> scheduler shared by clients of the token in this process.
+    # Twitter limits calls per user token. (user auth allows 180 searches per 15 minutes)
+    _rate_limit_schedulers = {}
+    _rate_limit_lock = threading.Lock()
+
+    @classmethod
+    def get_rate_limit_scheduler(cls, access_token):
+        with cls._rate_limit_lock:
+            scheduler = cls._rate_limit_schedulers.get(access_token)
+            if scheduler is None:
+                scheduler = cls._rate_limit_schedulers[access_token] = RateLimitScheduler(budget=180, window=900)
+            return scheduler
+
     @classmethod
     def create_oauth_handler(cls, consumer_key, consumer_secret, callback=None, proxy=''):
         return TweepyOAuthHandler(consumer_key=consumer_key, consumer_secret=consumer_secret,
                                   callback=callback, proxy=proxy)
 
     @classmethod
-    def create_api_client(cls, oauth_handler, access_token, access_token_secret, proxy=''):
+    def create_api_client(cls, oauth_handler, access_token, access_token_secret, proxy='', rate_limited=False):
+        """
+        :param rate_limited: pace calls by rate limitation of the access token, and retry calls rejected for it.
+                             Calls may block up to a window (15 minutes). For batch jobs only, not for web requests.
+        """
         auth = oauth_handler
         auth.set_access_token(access_token, access_token_secret)
-        api = tweepy.API(auth, proxy=proxy)
-        return api
+        if not rate_limited:
+            return tweepy.API(auth, proxy=proxy)
+        api = TweepyAPI(auth, proxy=proxy)
+        return RateLimitedAPI(api, cls.get_rate_limit_scheduler(access_token))
 
     TweepError = tweepy.TweepError
 
 
+class TweepyAPI(tweepy.API):
+    """
+    tweepy.API keeping last_response per thread, so it is the response of the call made by the thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        super(TweepyAPI, self).__init__(*args, **kwargs)
+
+    @property
+    def last_response(self):
+        return getattr(self._local, 'last_response', None)
+
+    @last_response.setter
+    def last_response(self, resp):
+        self._local.last_response = resp
+
+
+class RateLimitedAPI(object):
+    """
+    Proxy of TweepyAPI. API calls are paced by a RateLimitScheduler (per method)
+    and retried after the window resets if Twitter rejects them for rate limitation.
+    """
+
+    def __init__(self, api, scheduler):
+        self._api = api
+        self._scheduler = scheduler
+
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        api = self._api
+        scheduler = self._scheduler
+
+        # wraps() keeps attributes such as "pagination_mode" required by tweepy.Cursor
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            if kwargs.get('create'):
+                # tweepy.Cursor creates method instance without request.
+                return attr(*args, **kwargs)
+
+            while True:
+                with scheduler.throttle(name):
+                    api.last_response = None    # of this thread
+                    try:
+                        return attr(*args, **kwargs)
+                    except tweepy.RateLimitError as err:
+                        resp = getattr(err, 'response', None) or api.last_response
+                        scheduler.limited(name, getattr(resp, 'headers', None))
+                    finally:
+                        scheduler.update(name, getattr(api.last_response, 'headers', None))
+        return call
+
+
 class TweepyOAuthHandler(tweepy.OAuthHandler):
     """
     Replacement for tweepy OAuthHandler to enable proxy for Twitter oAuth
@@ -6,4 +6,7 @@ from django.apps import AppConfig
 
 class TwidoAppConfig(AppConfig):
     name = 'twido'
-    verbose_name = 'My Wonderful Life 2'
\ No newline at end of file
+    verbose_name = 'My Wonderful Life 2'
+
+    def ready(self):
+        from .models import events     # connect signal receivers
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from twido.models import RawStatus
+from twido.models.spider import compress_raw
+
+import simplejson as json
+import logging
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Minify and compress raw data of legacy (uncompressed) statuses.'
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            '--batch-size', '-b',
+            action='store',
+            dest='batch_size',
+            type=int,
+            default=500,
+            help='Count of statuses migrated per transaction. Default is 500.',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = int(options['batch_size'])
+        last_id = 0
+        count = 0
+        size = 0
+        compressed_size = 0
+
+        while True:
+            statuses = list(RawStatus.objects.filter(id__gt=last_id, raw_data__isnull=True).exclude(
+                raw_text=None).order_by('id').values_list('id', 'raw_text')[:batch_size])
+            if not statuses:
+                break
+
+            with transaction.atomic():
+                for pk, text in statuses:
+                    size += len(text.encode('utf-8'))
+                    try:
+                        text = json.dumps(json.loads(text), ensure_ascii=False, separators=(',', ':'))
+                    except ValueError:
+                        log.warning('Raw data of status (id=%d) is not JSON. Compressed as is.' % pk)
+                    data = compress_raw(text)
+                    RawStatus.objects.filter(id=pk).update(raw_data=data, raw_text=None)
+                    compressed_size += len(data)
+
+            count += len(statuses)
+            last_id = statuses[-1][0]
+            self.stdout.write('%d statuses compressed (last id %d).' % (count, last_id))
+
+        if count:
+            self.stdout.write('Done. %d statuses. %d bytes -> %d bytes.' % (count, size, compressed_size))
+        else:
+            self.stdout.write('Nothing to compress.')
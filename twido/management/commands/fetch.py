@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-from django.core.management.base import BaseCommand
-from services.spider import StorageType, TwitterSpider
+from django.core.management.base import BaseCommand, CommandError
+from services.spider import StorageType, TwitterSpider, FetchQuery
+from services.stream import StreamIngestor, ReplayFileSource, TwitterStreamSource, StreamError
 from ...utils import load_config
 
 
@@ -39,6 +40,75 @@ class Command(BaseCommand):
             help='Max count to fetch.',
         )
 
+        parser.add_argument(
+            '--batch-size', '-b',
+            action='store',
+            dest='batch_size',
+            type=int,
+            default=100,
+            help='Count of statuses inserted into DB per batch. 0 means one by one. Default is 100.',
+        )
+
+        parser.add_argument(
+            '--query', '-q',
+            action='append',
+            dest='queries',
+            default=[],
+            help='Search query (such as "#todo"). Can be specified multiple times. Default is "#todo".',
+        )
+
+        parser.add_argument(
+            '--lang', '-l',
+            action='append',
+            dest='langs',
+            default=[],
+            help='Language of search queries (or of tracked statuses with --stream). Each query is fetched per '
+                 'language. Requires --query unless --stream. Default is "en".',
+        )
+
+        parser.add_argument(
+            '--list',
+            action='append',
+            dest='lists',
+            default=[],
+            help='List timeline to fetch, in format "owner_screen_name/slug". Can be specified multiple times.',
+        )
+
+        parser.add_argument(
+            '--workers', '-w',
+            action='store',
+            dest='workers',
+            type=int,
+            default=4,
+            help='Count of queries fetched concurrently. Default is 4.',
+        )
+
+        parser.add_argument(
+            '--stream', '-s',
+            action='store_true',
+            dest='stream',
+            default=False,
+            help='Keep running and ingest from Twitter streaming filter endpoint (tracks search queries).',
+        )
+
+        parser.add_argument(
+            '--replay', '-r',
+            action='store',
+            type=str,
+            dest='replay',
+            default='',
+            help='Stream ingestion from a local line-delimited JSON file instead of Twitter.',
+        )
+
+        parser.add_argument(
+            '--queue-size',
+            action='store',
+            dest='queue_size',
+            type=int,
+            default=10000,
+            help='Max count of statuses pending in stream ingestion queue. Default is 10000.',
+        )
+
         parser.add_argument(
             '--test', '-e',
             action='store_true',
@@ -61,6 +131,21 @@ class Command(BaseCommand):
         storage = int(options['storage_types'])
         max = int(options['max'])
         test = bool(options['test'])
+        batch_size = int(options['batch_size'])
+        workers = int(options['workers'])
+
+        if options['langs'] and not options['queries'] and not options['stream']:
+            raise CommandError('--lang applies to search queries. Specify them with --query.')
+
+        queries = []
+        for q in options['queries']:
+            for lang in options['langs'] or ['en']:
+                queries.append(FetchQuery.search(q, lang=lang))
+        for lst in options['lists']:
+            owner, sep, slug = lst.partition('/')
+            if not owner or not slug:
+                raise CommandError('Invalid --list "%s". Format is "owner_screen_name/slug".' % lst)
+            queries.append(FetchQuery.list_timeline(owner, slug))
 
         cfgs = load_config(config_file=config_file)
         spider = TwitterSpider(consumer_key=cfgs.twitter.consumer_key,
@@ -68,5 +153,19 @@ class Command(BaseCommand):
                                access_token=cfgs.twitter.access_token,
                                access_token_secret=cfgs.twitter.access_token_secret,
                                storage=storage,
-                               proxy=cfgs.common.proxy)
-        spider.fetch(test=test, limited=max)
+                               proxy=cfgs.common.proxy,
+                               batch_size=batch_size)
+
+        if options['replay'] or options['stream']:
+            if options['replay']:
+                source = ReplayFileSource(options['replay'])
+            else:
+                source = TwitterStreamSource(spider.auth, track=options['queries'] or ['#todo'],
+                                             languages=options['langs'] or ['en'])
+            ingestor = StreamIngestor(spider, source, queue_size=int(options['queue_size']))
+            try:
+                ingestor.run(limited=max)
+            except StreamError as err:
+                raise CommandError(err)
+        else:
+            spider.fetch(test=test, limited=max, queries=queries, workers=workers)
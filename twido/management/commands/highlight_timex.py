@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from twido.models.task import TaskMeta
+from twido.parser import Timex3Parser
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Pre-compute highlighted html of task TIMEX3 (for tasks parsed before it is computed at parsing).'
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            '--batch-size', '-b',
+            action='store',
+            dest='batch_size',
+            type=int,
+            default=500,
+            help='Count of task metas updated per transaction. Default is 500.',
+        )
+
+        parser.add_argument(
+            '--all', '-a',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Check all task metas (not only never highlighted) and re-compute those whose timex changed.',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = int(options['batch_size'])
+        metas = TaskMeta.objects.exclude(timex=None).exclude(timex='')
+        if not options['all']:
+            metas = metas.filter(Q(timex_hash=None) | Q(timex_html=None))
+
+        last_id = 0
+        count = 0
+        updated = 0
+        while True:
+            rows = list(metas.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'timex', 'timex_hash')[:batch_size])
+            if not rows:
+                break
+
+            with transaction.atomic():
+                for pk, timex, timex_hash in rows:
+                    new_hash = TaskMeta.get_timex_hash(timex)
+                    if options['all'] and timex_hash == new_hash:
+                        continue    # up to date
+                    html = Timex3Parser.highlight(timex)
+                    if isinstance(html, bytes):
+                        html = html.decode('utf-8')
+                    TaskMeta.objects.filter(id=pk).update(timex_html=html, timex_hash=new_hash)
+                    updated += 1
+
+            count += len(rows)
+            last_id = rows[-1][0]
+            self.stdout.write('%d task metas checked, %d highlighted (last id %d).' % (count, updated, last_id))
+
+        if count:
+            self.stdout.write('Done. %d task metas highlighted.' % updated)
+        else:
+            self.stdout.write('Nothing to highlight.')
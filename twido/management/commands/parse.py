@@ -4,6 +4,7 @@
 from django.core.management.base import BaseCommand
 from services.storage import StorageType
 from services.parser import TwitterParser
+from services.timex_cache import CacheType, create_cache
 from ...utils import load_config
 
 
@@ -37,6 +38,80 @@ class Command(BaseCommand):
             help='Specify a config file. Default is config.ini',
         )
 
+        parser.add_argument(
+            '--workers', '-w',
+            action='store',
+            dest='workers',
+            type=int,
+            default=4,
+            help='Count of concurrent requests to parser endpoint. Default is 4.',
+        )
+
+        parser.add_argument(
+            '--batch-size', '-b',
+            action='store',
+            dest='batch_size',
+            type=int,
+            default=1,
+            help='Count of statuses annotated in one parser endpoint request. '
+                 'Falls back to single requests if endpoint does not support batch. Default is 1 (no batch).',
+        )
+
+        parser.add_argument(
+            '--write-batch-size',
+            action='store',
+            dest='write_batch_size',
+            type=int,
+            default=200,
+            help='Count of statuses filtered and saved to DB by bulk at a time (max 500). Default is 200.',
+        )
+
+        parser.add_argument(
+            '--cache', '-c',
+            action='store',
+            dest='cache',
+            type=str,
+            choices=CacheType.choices,
+            default=CacheType.MEMORY,
+            help='Cache of annotation results. (%s) Default is memory.' % ', '.join(CacheType.choices),
+        )
+
+        parser.add_argument(
+            '--cache-size',
+            action='store',
+            dest='cache_size',
+            type=int,
+            default=10000,
+            help='Max count of cached annotation results (memory, sqlite). Default is 10000.',
+        )
+
+        parser.add_argument(
+            '--endpoint-version',
+            action='store',
+            dest='endpoint_version',
+            type=str,
+            default='',
+            help='Version of parser endpoint. Cached results of other versions are not used.',
+        )
+
+        parser.add_argument(
+            '--timeout',
+            action='store',
+            dest='timeout',
+            type=float,
+            default=30,
+            help='Seconds to wait for parser endpoint response. Default is 30.',
+        )
+
+        parser.add_argument(
+            '--retries',
+            action='store',
+            dest='retries',
+            type=int,
+            default=3,
+            help='Max retries of failed parser endpoint requests. Default is 3.',
+        )
+
         parser.add_argument(
             '--include-parsed', '-i',
             action='store_true',
@@ -50,5 +125,16 @@ class Command(BaseCommand):
         storage = int(options['storage_types'])
         include_parsed = options['include_parsed']
         cfgs = load_config(config_file=config_file)
-        parser = TwitterParser(endpoint=cfgs.common.parser_endpoint, storage=storage)
-        parser.parse(include_parsed=include_parsed)
+        workers = int(options['workers'])
+        endpoint = cfgs.common.parser_endpoint
+        cache = create_cache(options['cache'], size=options['cache_size'],
+                             version='%s|%s' % (endpoint, options['endpoint_version']))
+        parser = TwitterParser(endpoint=endpoint, storage=storage, workers=workers,
+                               timeout=options['timeout'], retries=options['retries'],
+                               batch_size=options['batch_size'], write_batch_size=options['write_batch_size'],
+                               cache=cache)
+        try:
+            parser.parse(include_parsed=include_parsed)
+        finally:
+            if cache is not None:
+                cache.close()
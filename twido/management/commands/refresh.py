@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from services.refresher import TwitterAccountRefresher
+from ...utils import load_config
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            '--interval', '-i',
+            action='store',
+            dest='interval',
+            type=int,
+            default=3600,
+            help='Seconds between refreshes. 0 means refresh once and exit. Default is 3600.',
+        )
+
+        parser.add_argument(
+            '--stale-hours',
+            action='store',
+            dest='stale_hours',
+            type=float,
+            default=24,
+            help='Refresh accounts not refreshed within the hours. Default is 24.',
+        )
+
+        parser.add_argument(
+            '--max', '-m',
+            action='store',
+            dest='max',
+            type=int,
+            default=0,
+            help='Max count of accounts per refresh. 0 means no limitation.',
+        )
+
+        parser.add_argument(
+            '--config-file', '-f',
+            action='store',
+            type=str,
+            dest='config_file',
+            default='config.ini',
+            help='Specify a config file. Default is config.ini',
+        )
+
+    def handle(self, *args, **options):
+        cfgs = load_config(config_file=options['config_file'])
+        refresher = TwitterAccountRefresher(consumer_key=cfgs.twitter.consumer_key,
+                                            consumer_secret=cfgs.twitter.consumer_secret,
+                                            access_token=cfgs.twitter.access_token,
+                                            access_token_secret=cfgs.twitter.access_token_secret,
+                                            stale_hours=options['stale_hours'],
+                                            proxy=cfgs.common.proxy)
+        refresher.run(interval=options['interval'], limited=options['max'])
@@ -2,7 +2,8 @@
 # coding: utf-8
 
 from django.core.management.base import BaseCommand
-from services.reminder import Reminder
+from services.reminder import run_workers, benchmark
+from services.delivery import Dispatcher, SinkType, create_sink
 from ...utils import load_config
 
 
@@ -11,20 +12,87 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
 
         parser.add_argument(
-            '--max', '-m',
+            '--interval', '-i',
             action='store',
-            dest='max',
+            dest='interval',
+            type=float,
+            default=1.0,
+            help='Seconds between polls of task changes. Default is 1.',
+        )
+
+        parser.add_argument(
+            '--window', '-w',
+            action='store',
+            dest='window',
+            type=int,
+            default=3600,
+            help='Seconds ahead tasks are loaded into memory. Default is 3600.',
+        )
+
+        parser.add_argument(
+            '--workers', '-n',
+            action='store',
+            dest='workers',
+            type=int,
+            default=1,
+            help='Count of worker processes. Default is 1.',
+        )
+
+        parser.add_argument(
+            '--shards',
+            action='store',
+            dest='shards',
             type=int,
             default=0,
-            help='Max count to fetch.',
+            help='Count of shards of profiles. 0 means one per worker. Checkpoints are per shard. When it is '
+                 'changed, new shards start from the earliest checkpoint of the old ones.',
         )
 
         parser.add_argument(
-            '--test', '-e',
-            action='store_true',
-            dest='test',
-            default=False,
-            help='If test specified, will only fetch tester users.',
+            '--sink', '-s',
+            action='store',
+            dest='sink',
+            choices=SinkType.choices,
+            default=SinkType.LOG,
+            help='Where reminders are delivered. "channel" means the channel configured by each user. '
+                 'smtp and webhook are configured in [reminder] section of config file. Default is log.',
+        )
+
+        parser.add_argument(
+            '--delivery-workers',
+            action='store',
+            dest='delivery_workers',
+            type=int,
+            default=8,
+            help='Max count of deliveries in progress per worker. Default is 8.',
+        )
+
+        parser.add_argument(
+            '--bench',
+            action='store',
+            dest='bench',
+            type=int,
+            default=0,
+            help='Benchmark reminding the count of tasks due at the same time by the workers and exit. '
+                 'Run it against a stand-in database.',
+        )
+
+        parser.add_argument(
+            '--bench-profiles',
+            action='store',
+            dest='bench_profiles',
+            type=int,
+            default=100,
+            help='Count of profiles bench tasks belong to. Default is 100.',
+        )
+
+        parser.add_argument(
+            '--bench-delay',
+            action='store',
+            dest='bench_delay',
+            type=float,
+            default=1.0,
+            help='Milliseconds of simulated delivery to a profile in benchmark. Default is 1.',
         )
 
         parser.add_argument(
@@ -37,6 +105,21 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
-        reminder = Reminder()
-        reminder.start()
+        if options['bench'] > 0:
+            stats = benchmark(count=options['bench'], workers=options['workers'],
+                              profiles=options['bench_profiles'], delay=options['bench_delay'])
+            self.stdout.write('Benchmark: %s' % stats)
+            return
+
+        cfgs = {}
+        if options['sink'] != SinkType.LOG:
+            cfgs = load_config(config_file=options['config_file'])
+            cfgs = cfgs.reminder if 'reminder' in cfgs else {}
+        dispatcher = Dispatcher(create_sink(options['sink'], cfgs), workers=options['delivery_workers'])
+
+        try:
+            run_workers(workers=options['workers'], shards=options['shards'], interval=options['interval'],
+                        window=options['window'], on_remind=dispatcher)
+        except KeyboardInterrupt:
+            pass
 
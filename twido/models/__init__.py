@@ -4,7 +4,7 @@
 from .admins import SocialAccountAdmin, ConfigAdmin, RawStatusAdmin, UserProfileCreationForm
 from .consts import SocialPlatform, TaskStatus, Gender, Visibility
 from .common import UserProfile, ProfileBasedModel, Config
-from .task import List, Task, SysList
+from .task import List, Task, SysList, TaskChange, ReminderLease
 from .social import SocialAccount
 from .spider import RawStatus
 from .utils import *
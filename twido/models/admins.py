@@ -35,6 +35,10 @@ class I18N_MSGS(object):
 
 class RawStatusAdmin(admin.ModelAdmin):
     list_display = ('id', 'rawid', 'source', 'created_at', 'username', 'text', 'timestamp')
+
+    def get_queryset(self, request):
+        # raw data is large. it's loaded on access only (such as in change form).
+        return super(RawStatusAdmin, self).get_queryset(request).defer('raw_text', 'raw_data')
     # exclude = ['raw']
     # fieldsets = (
     #     (None, {
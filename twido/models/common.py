@@ -12,6 +12,7 @@ from django.contrib.auth.hashers import make_password
 from django.utils import timezone
 from django.utils.translation import pgettext_lazy
 from .consts import Gender
+from twido.utils import VersionedCache
 
 try:
     UserModel = get_user_model()
@@ -21,6 +22,10 @@ except AppRegistryNotReady:
 import logging
 log = logging.getLogger(__name__)
 
+# configs cached per profile. invalidated on saving/deleting configs. Requires a cache shared by all processes.
+# (see CACHES) Configs written often by other processes (such as checkpoints) should be read from DB directly.
+config_cache = VersionedCache('twido:conf', timeout=300)
+
 
 class UserProfile(models.Model):
     """
@@ -224,15 +229,33 @@ class Config(ProfileBasedModel):
     def __str__(self):
         return '%s=%s' % (self.name, self.value)
 
+    def save(self, *args, **kwargs):
+        super(Config, self).save(*args, **kwargs)
+        config_cache.invalidate(self.profile_id)
+
+    def delete(self, *args, **kwargs):
+        profile_id = self.profile_id
+        result = super(Config, self).delete(*args, **kwargs)
+        config_cache.invalidate(profile_id)
+        return result
+
+    @classmethod
+    def get_user_confs(cls, profile):
+        """
+        :return: dict of name -> Config of the profile. Loaded by one query and cached per profile.
+        """
+        return config_cache.get_or_set(profile.id, 'all', lambda: dict(
+            (opt.name, opt) for opt in cls.objects.filter(profile=profile)))
+
     @classmethod
     def get_user_conf(cls, profile, name):
-        try:
-            return cls.objects.get(profile=profile, name=name)
-        except cls.DoesNotExist:
-            return None
+        return cls.get_user_confs(profile).get(name)
 
     @classmethod
     def get_or_create_user_conf(cls, profile, name):
+        opt = cls.get_user_confs(profile).get(name)
+        if opt is not None:
+            return opt, False
         return cls.objects.get_or_create(profile=profile, name=name)
 
     @classmethod
@@ -243,17 +266,12 @@ class Config(ProfileBasedModel):
 
     @classmethod
     def get_sys_conf(cls, name):
-        try:
-            return cls.objects.get(profile=UserProfile.get_sys_profile(), name=name)
-        except cls.DoesNotExist:
-            return None
+        return cls.get_user_conf(UserProfile.get_sys_profile(), name)
 
     @classmethod
     def get_or_create_sys_conf(cls, name):
-        return cls.objects.get_or_create(profile=UserProfile.get_sys_profile(), name=name)
+        return cls.get_or_create_user_conf(UserProfile.get_sys_profile(), name)
 
     @classmethod
     def set_sys_conf(cls, name, value):
-        opt, created = cls.objects.get_or_create(profile=UserProfile.get_sys_profile(), name=name)
-        opt.value = value
-        opt.save()
+        cls.set_user_conf(UserProfile.get_sys_profile(), name, value)
@@ -145,6 +145,7 @@ class TaskStatus(object):
     EXPIRED = 9
     DONE = 10
     CANCEL = 11
+    OPEN = (NEW, STARTED, PAUSED, EXPIRED)     # neither done nor cancelled
     _texts = {
         NEW: _('New'),
         STARTED: _('Started'),
@@ -6,12 +6,12 @@ To process model signals
 """
 from django.contrib.auth import get_user_model
 from django.core.exceptions import AppRegistryNotReady
-from django.db.models.signals import post_save, post_migrate
+from django.db.models.signals import post_save, post_delete, post_migrate
 from django.dispatch import receiver
 from django.utils import timezone
 from ..apps import TwidoAppConfig
 from .common import UserProfile
-from .list import List
+from .task import List, Task, TaskChange, task_cache
 
 try:
     UserModel = get_user_model()
@@ -57,3 +57,17 @@ log = logging.getLogger(__name__)
 #     if sender.name == TwidoAppConfig.name:
 #         UserProfile.init_data()
 #
+
+
+@receiver(post_save, sender=Task)
+def post_save_task(sender, instance, created, raw=False, **kwargs):
+    if raw or created and instance.due is None:
+        return      # loading fixtures or nothing to schedule
+    TaskChange.record(instance)
+    task_cache.invalidate(instance.profile_id)
+
+
+@receiver(post_delete, sender=Task)
+def post_delete_task(sender, instance, **kwargs):
+    TaskChange.record(instance, deleted=True)
+    task_cache.invalidate(instance.profile_id)
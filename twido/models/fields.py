@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Custom model fields
+"""
+from django.core.exceptions import ValidationError
+from django.db import models
+from pyutils.json import to_serializable
+
+import simplejson as json
+import logging
+log = logging.getLogger(__name__)
+
+
+class RawJSON(str):
+    """
+    JSON text not decoded yet. Assign it to a JSONTextField to save already encoded JSON as is.
+    """
+    pass
+
+
+class JSONTextDescriptor(object):
+    """
+    Decodes JSON text of the field lazily on first access, per instance.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.field.attname not in instance.__dict__:
+            # deferred field. load it as DeferredAttribute does.
+            instance.refresh_from_db(fields=[self.field.attname])
+        value = instance.__dict__.get(self.field.attname)
+        if isinstance(value, RawJSON):
+            value = instance.__dict__[self.field.attname] = self.field.decode(value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class JSONTextField(models.TextField):
+    """
+    JSON stored in a text column. Loaded text is decoded on first access of the attribute.
+    Unaccessed values are saved back as is (no decoding and encoding).
+    Unchanged values are not saved at all by models of JSONTextModelMixin.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param encoder_kwargs: kwargs of json.dumps. Default is compact JSON.
+        """
+        self.encoder_kwargs = kwargs.pop('encoder_kwargs', {'separators': (',', ':'), 'ensure_ascii': False})
+        super(JSONTextField, self).__init__(*args, **kwargs)
+
+    @property
+    def loaded_attname(self):
+        return '_%s_loaded' % self.attname
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(JSONTextField, self).contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.attname, JSONTextDescriptor(self))
+
+    def decode(self, text):
+        if not text:
+            return None
+        try:
+            return json.loads(text)
+        except ValueError:
+            log.warning('Invalid JSON in %s. Kept as text.' % self)
+            return str(text)
+
+    def encode(self, value):
+        if value is None:
+            return None if self.null else ''
+        if isinstance(value, RawJSON):
+            return str(value)
+        return json.dumps(value, default=to_serializable, **self.encoder_kwargs)
+
+    def get_default(self):
+        if self.has_default():
+            return super(JSONTextField, self).get_default()
+        return None     # not the empty string of text fields, which would be saved as '""'.
+
+    def is_dirty(self, instance):
+        """
+        :return: whether value changed since loaded from DB. Always True if not loaded.
+        """
+        if self.loaded_attname not in instance.__dict__:
+            return True
+        loaded = instance.__dict__[self.loaded_attname]
+        value = instance.__dict__.get(self.attname)
+        if isinstance(value, RawJSON) or value is None or loaded is None:
+            return value != loaded
+        return value != self.decode(loaded)
+
+    def from_db_value(self, value, expression, connection, context):
+        return None if value is None else RawJSON(value)
+
+    def to_python(self, value):
+        if isinstance(value, str) and not isinstance(value, RawJSON):
+            try:
+                return json.loads(value) if value else None
+            except ValueError:
+                raise ValidationError('Invalid JSON', code='invalid')
+        return value
+
+    def pre_save(self, model_instance, add):
+        # read without decoding. value never accessed is saved as loaded.
+        return model_instance.__dict__.get(self.attname)
+
+    def get_prep_value(self, value):
+        return self.encode(value)
+
+    def value_from_object(self, obj):
+        # JSON text for forms and serialization.
+        value = obj.__dict__.get(self.attname)
+        return value if isinstance(value, RawJSON) else self.encode(value)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+    def save_form_data(self, instance, data):
+        setattr(instance, self.attname, self.to_python(data))
+
+
+class JSONTextModelMixin(object):
+    """
+    Model mixin skipping JSONTextFields not changed on updating (saving a model loaded from DB).
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(JSONTextModelMixin, cls).from_db(db, field_names, values)
+        for field in cls._meta.concrete_fields:
+            if isinstance(field, JSONTextField) and field.attname in instance.__dict__:
+                instance.__dict__[field.loaded_attname] = instance.__dict__[field.attname]
+        return instance
+
+    def save(self, *args, **kwargs):
+        fields = self._meta.concrete_fields
+        json_fields = [field for field in fields if isinstance(field, JSONTextField)]
+        dirty = [field for field in json_fields if field.is_dirty(self)]
+        if len(dirty) < len(json_fields) and not self._state.adding and not kwargs.get('force_insert') and \
+                kwargs.get('update_fields') is None:
+            # loaded fields except the clean ones. (deferred fields are not saved, as Model.save does)
+            kwargs['update_fields'] = [field.attname for field in fields if not field.primary_key and
+                                       field.attname in self.__dict__ and (field in dirty or field not in json_fields)]
+        super(JSONTextModelMixin, self).save(*args, **kwargs)
+        for field in dirty:
+            self.__dict__.pop(field.loaded_attname, None)   # saved. dirty until loaded again.
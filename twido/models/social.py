@@ -9,16 +9,17 @@ from django.templatetags.static import static
 from django.utils import timezone
 from .common import ProfileBasedModel
 from .consts import SocialPlatform
+from .fields import JSONTextField, JSONTextModelMixin
 
 
-class SocialAccount(ProfileBasedModel):
+class SocialAccount(JSONTextModelMixin, ProfileBasedModel):
     """
     Social accounts such as Twitter, Facebook and Weibo.
     """
     account = models.CharField(max_length=100, db_index=True)      # maybe screen_name, email or etc.
     platform = models.CharField(max_length=2, choices=SocialPlatform.Choices, default=SocialPlatform.TWITTER)
     name = models.CharField(max_length=100, null=True, blank=True)  # nick name, user.first_name/user.last_name
-    tokens = models.TextField(verbose_name='Tokens JSON')
+    tokens = JSONTextField(verbose_name='Tokens JSON', default=dict)
     rawid = models.CharField(max_length=100, null=True, blank=True)
     created_at = models.DateTimeField(editable=False)
 
@@ -9,11 +9,59 @@ Spider and parser related models
 from django.db import models
 from django.utils import timezone
 from .consts import SocialPlatform
+import zlib
+
+
+# Preset dictionary for zlib. Tweets are short, so most of the payload is these repeated keys.
+# NEVER change it. Add a new codec (and dictionary) instead, old rows still need it to decompress.
+_raw_zdict_v1 = ','.join('"%s":' % k for k in (
+    'created_at', 'id', 'id_str', 'text', 'truncated', 'entities', 'hashtags', 'symbols', 'user_mentions',
+    'urls', 'url', 'expanded_url', 'display_url', 'indices', 'metadata', 'iso_language_code', 'result_type',
+    'source', 'in_reply_to_status_id', 'in_reply_to_status_id_str', 'in_reply_to_user_id',
+    'in_reply_to_user_id_str', 'in_reply_to_screen_name', 'user', 'name', 'screen_name', 'location',
+    'description', 'protected', 'followers_count', 'friends_count', 'listed_count', 'favourites_count',
+    'utc_offset', 'time_zone', 'geo_enabled', 'verified', 'statuses_count', 'lang', 'contributors_enabled',
+    'is_translator', 'is_translation_enabled', 'profile_background_color', 'profile_background_image_url',
+    'profile_background_image_url_https', 'profile_background_tile', 'profile_image_url',
+    'profile_image_url_https', 'profile_banner_url', 'profile_link_color', 'profile_sidebar_border_color',
+    'profile_sidebar_fill_color', 'profile_text_color', 'profile_use_background_image',
+    'has_extended_profile', 'default_profile', 'default_profile_image', 'following', 'follow_request_sent',
+    'notifications', 'translator_type', 'geo', 'coordinates', 'place', 'contributors', 'retweeted_status',
+    'is_quote_status', 'retweet_count', 'favorite_count', 'favorited', 'retweeted', 'possibly_sensitive',
+)).encode('utf-8') + b'null,false,true,"<a href=\\"http://twitter.com\\" rel=\\"nofollow\\">https://t.co/'
+
+RAW_CODEC_ZLIB = b'\x01'        # zlib with preset dictionary v1
+
+
+def compress_raw(text):
+    """
+    Compress raw status text. (minify it before compressing for better ratio)
+    :param text: str
+    :return: bytes led by codec byte
+    """
+    c = zlib.compressobj(level=9, zdict=_raw_zdict_v1)
+    return RAW_CODEC_ZLIB + c.compress(text.encode('utf-8')) + c.flush()
+
+
+def decompress_raw(data):
+    """
+    :param data: bytes returned by compress_raw
+    :return: raw status text
+    """
+    data = bytes(data)
+    codec = data[:1]
+    if codec == RAW_CODEC_ZLIB:
+        d = zlib.decompressobj(zdict=_raw_zdict_v1)
+        return (d.decompress(data[1:]) + d.flush()).decode('utf-8')
+    raise ValueError('Unknown raw status codec %r' % codec)
 
 
 class RawStatus(models.Model):
     """
     Base class for all raw statuses.
+
+    Raw data is kept compressed in "raw_data" and decompressed lazily on access of "raw".
+    "raw_text" holds uncompressed data of legacy rows (not migrated yet by "compress_raw" command).
     """
     id = models.BigAutoField(primary_key=True)
     rawid = models.CharField(max_length=50, db_index=True, unique=True, verbose_name='Raw ID')
@@ -23,7 +71,24 @@ class RawStatus(models.Model):
     text = models.TextField(verbose_name='Status Text')
     source = models.CharField(max_length=2, choices=SocialPlatform.Choices)
     parsed = models.BooleanField(default=False)
-    raw = models.TextField(verbose_name='Raw Data')
+    raw_text = models.TextField(db_column='raw', null=True, blank=True, verbose_name='Raw Data (uncompressed)')
+    raw_data = models.BinaryField(null=True, editable=False, verbose_name='Raw Data (compressed)')
+
+    _raw = None     # (raw_data, decompressed text)
+
+    @property
+    def raw(self):
+        if self.raw_data is None:
+            return self.raw_text or ''
+        if self._raw is None or self._raw[0] is not self.raw_data:
+            self._raw = (self.raw_data, decompress_raw(self.raw_data))
+        return self._raw[1]
+
+    @raw.setter
+    def raw(self, value):
+        self.raw_data = compress_raw(value) if value else None
+        self.raw_text = None
+        self._raw = (self.raw_data, value)
 
     def __str__(self):
         return 'status(%s, id=%s, rawid=%s, user=%s, text="%s")' % (
@@ -14,17 +14,23 @@ from django.utils.functional import SimpleLazyObject
 from django.utils.translation import ugettext_lazy as _, pgettext_lazy, ugettext_noop
 from django.db import transaction
 from .common import ProfileBasedModel, UserProfile
+from .fields import JSONTextField, JSONTextModelMixin
 from .consts import TaskStatus, Visibility
 from pyutils.langutil import PropertyDict
+from twido.utils import VersionedCache
 from .social import SocialAccount
 from .spider import RawStatus
 
-import simplejson as json
+import hashlib
 import logging
 from twido.parser import Timex3Parser
 
 log = logging.getLogger(__name__)
 
+# tasks cached per profile. invalidated on saving/deleting tasks (see events.py), and explicitly after bulk changes
+# (bulk_create, queryset update) which send no signals. Requires a cache shared by all processes. (see CACHES)
+task_cache = VersionedCache('twido:tasks', timeout=60)
+
 
 class List(ProfileBasedModel):
     """
@@ -123,11 +129,33 @@ class Task(ProfileBasedModel):
     content = models.TextField(null=True, blank=True)
     raw = models.OneToOneField(to=RawStatus, null=True, blank=True)
 
+    class Meta:
+        index_together = [('profile', 'status', 'due')]     # open tasks of a profile by due
+
     def save(self, *args, **kwargs):
         if not self.created_at:
             self.created_at = timezone.now()
         super(Task, self).save(*args, **kwargs)
 
+    @classmethod
+    def get_expiring(cls, profile, hours=3, days=0):
+        """
+        :return: list of open tasks of the profile due in the coming hours/days, the earliest first.
+        Cached per profile.
+        """
+        start = timezone.now()
+        end = start + timedelta(days=days, hours=hours)
+
+        def load():
+            # loaded a timeout longer, so tasks coming into the range while cached are included.
+            until = end + timedelta(seconds=task_cache.timeout)
+            return list(cls.objects.filter(profile=profile, status__in=TaskStatus.OPEN, due__gte=start,
+                                           due__lte=until).only('id', 'title', 'due', 'status', 'profile')
+                        .order_by('due'))
+
+        tasks = task_cache.get_or_set(profile.id, 'expiring:%s:%s' % (days, hours), load)
+        return [task for task in tasks if start <= task.due <= end]
+
     def get_owner_name(self):
         if self.profile and not self.profile.is_sys:
             return self.profile.get_name()
@@ -161,34 +189,111 @@ class Task(ProfileBasedModel):
         return '%s (id=%d)' % (self.title, self.id)
 
 
-class TaskMeta(models.Model):
+class TaskMeta(JSONTextModelMixin, models.Model):
     task = models.OneToOneField(to=Task, related_name='meta')
     timex = models.TextField(null=True, blank=True)
-    dates = models.TextField(null=True, blank=True)
-    tags = models.TextField(null=True, blank=True)
-    persons = models.TextField(null=True, blank=True)
+    dates = JSONTextField(null=True, blank=True)
+    tags = JSONTextField(null=True, blank=True)
+    persons = JSONTextField(null=True, blank=True)
     simple_text = models.TextField(null=True, blank=True)
+    timex_html = models.TextField(null=True, blank=True, editable=False)    # highlighted timex
+    timex_hash = models.CharField(max_length=40, null=True, blank=True, editable=False)  # sha1 of highlighted timex
 
-    _tags = []
-    _dates = []
+    @staticmethod
+    def get_timex_hash(timex):
+        return hashlib.sha1(timex.encode('utf-8')).hexdigest() if timex else None
 
     def highlight_timex(self):
-        return Timex3Parser.highlight(self.timex)
+        """
+        Highlighted html of timex. Computed on first access (if not at parsing) and stored with hash of timex.
+        Re-computed if timex changed.
+        """
+        if not self.timex:
+            return ''
+        timex_hash = self.get_timex_hash(self.timex)
+        if self.timex_html is None or self.timex_hash != timex_hash:
+            self.set_timex_html(Timex3Parser.highlight(self.timex), timex_hash)
+            if self.pk:
+                TaskMeta.objects.filter(pk=self.pk).update(timex_html=self.timex_html, timex_hash=self.timex_hash)
+        return self.timex_html
+
+    def set_timex_html(self, html, timex_hash=None):
+        """
+        :param html: highlighted html of current timex.
+        :param timex_hash: hash of current timex. Computed if not given.
+        """
+        if isinstance(html, bytes):
+            html = html.decode('utf-8')
+        self.timex_html = html
+        self.timex_hash = timex_hash or self.get_timex_hash(self.timex)
 
     def get_dates(self):
-        if not self._dates:
-            self._dates = json.loads(self.dates)
-        return self._dates
+        return self.dates or []
 
     def get_tags(self):
-        if not self._tags:
-            self._tags = json.loads(self.tags)
-        return self._tags
+        return self.tags or []
 
     def save(self, *args, **kwargs):
+        if self.timex_hash and self.timex_hash != self.get_timex_hash(self.timex):
+            # timex changed. highlighted html is re-computed on next access.
+            self.timex_html = None
+            self.timex_hash = None
         super(TaskMeta, self).save(*args, **kwargs)
-        self._tags = []
-        self._dates = []
+
+
+class TaskChange(models.Model):
+    """
+    Change log of task schedules. Written on saving/deleting tasks (see events.py) and consumed by reminder.
+    Consumed rows are deleted by the consumer.
+    """
+    id = models.BigAutoField(primary_key=True)
+    task_id = models.BigIntegerField(db_index=True)     # not a ForeignKey. task may be deleted.
+    profile_id = models.BigIntegerField()
+    due = models.DateTimeField(null=True, blank=True)
+    status = models.IntegerField(choices=TaskStatus.Choices, null=True, blank=True)
+    deleted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def record(cls, task, deleted=False):
+        return cls.objects.create(task_id=task.id, profile_id=task.profile_id, due=task.due,
+                                  status=task.status, deleted=deleted)
+
+    @classmethod
+    def record_all(cls, tasks):
+        """
+        Record changes of tasks saved without signals (such as by bulk_create). Tasks must have ids.
+        """
+        return cls.objects.bulk_create([cls(task_id=task.id, profile_id=task.profile_id, due=task.due,
+                                            status=task.status) for task in tasks])
+
+    def is_scheduled(self):
+        """
+        :return: whether the task needs reminding after the change.
+        """
+        return not self.deleted and self.due is not None and \
+            self.status not in (TaskStatus.DONE, TaskStatus.CANCEL)
+
+    def __str__(self):
+        return 'task %d %s (due=%s)' % (self.task_id, 'deleted' if self.deleted else 'changed', self.due)
+
+
+class ReminderLease(models.Model):
+    """
+    Ownership of a shard of reminding (profiles of profile id % shards == shard) by a reminder worker.
+    Owner renews it before expired. Expired lease can be taken by another worker.
+    """
+    shards = models.IntegerField()
+    shard = models.IntegerField()
+    owner = models.CharField(max_length=100, blank=True, default='')
+    expires = models.DateTimeField()
+    claimed_by = models.CharField(max_length=100, blank=True, default='')     # preferred worker waiting for it
+
+    class Meta:
+        unique_together = ('shards', 'shard')
+
+    def __str__(self):
+        return 'shard %d/%d owned by %s until %s' % (self.shard, self.shards, self.owner or '-', self.expires)
 
 
 class SysList(object):
@@ -6,6 +6,7 @@ Model utilities
 """
 from django.db import transaction
 from . import List, Task, SocialAccount, UserProfile, Config
+from .task import task_cache
 
 
 @transaction.atomic
@@ -24,6 +25,10 @@ def replace_profile(origin_profile, new_profile, social_platform='', del_origin=
     Task.objects.filter(profile=origin_profile, list=origin_default_list).update(
         profile=new_profile, list=new_default_list)
     Task.objects.filter(profile=origin_profile).update(profile=new_profile)
+    # queryset update sends no signals.
+    task_cache.invalidate(origin_profile.id)
+    task_cache.invalidate(new_profile.id)
+
     if social_platform:
         SocialAccount.objects.filter(platform=social_platform).update(profile=new_profile)
     else:
@@ -5,8 +5,13 @@
 Parse given TIMEX3 XML and text to give out dates, simple text, tags and etc.
 """
 import re
+import threading
+import simplejson as json
 import parsedatetime
-from datetime import datetime
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from twido.utils import LRUCache
+from pyutils.json import to_serializable
 from pygments.lexers.html import XmlLexer
 from pygments.formatters.html import HtmlFormatter
 from pygments import highlight
@@ -20,6 +25,158 @@ import logging
 log = logging.getLogger(__name__)
 
 
+class DateResolver(object):
+    """
+    Resolve TIMEX3 expressions into datetimes relative to a base time.
+
+    TIMEX3 values are resolved directly:
+        DATE        2017-06-16, 2017-06, 2017, 2017-W25, 2017-06-16T19:00, PRESENT_REF
+        TIME        2017-06-16T19:00, T19:00, TMO/TAF/TEV/TNI (morning, afternoon, evening, night)
+        DURATION    P1D, P1W, PT24H, P22Y ... resolved as base time + duration
+        SET         P1D, P1W, TMO ... resolved as the next occurrence
+    Other values fall back to parsing text in natural language (parsedatetime).
+    Unknown quantities (such as PXY "years", XXXX-WXX-1) and PAST_REF/FUTURE_REF are not resolved.
+
+    Resolutions are memoized in a bounded LRU cache. Calendars of parsedatetime are reused per thread.
+    """
+
+    _months = dict((m, i) for i, m in enumerate(
+        ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1))
+    _part_hours = {'MO': 8, 'AF': 14, 'EV': 19, 'NI': 22}
+    _duration_units = (('Y', 365 * 86400), ('M', 30 * 86400), ('W', 7 * 86400), ('D', 86400),
+                       ('H', 3600), ('TM', 60), ('S', 1))
+
+    _re_datetime = re.compile(r'^(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?(?:T(\d{2}):(\d{2})(?::(\d{2}))?)?$')
+    _re_unresolvable = re.compile(r'^(?:XXXX-|PAST_REF$|FUTURE_REF$)')
+    _re_week = re.compile(r'^(\d{4})-W(\d{2})$')
+    _re_clock = re.compile(r'^T(\d{2}):(\d{2})(?::(\d{2}))?$')
+    _re_part = re.compile(r'^(?:(\d{4})-(\d{2})-(\d{2}))?T(MO|AF|EV|NI)$')
+    _re_duration = re.compile(r'^P(?:([\d.]+)Y)?(?:([\d.]+)M)?(?:([\d.]+)W)?(?:([\d.]+)D)?'
+                              r'(?:T(?:([\d.]+)H)?(?:([\d.]+)M)?(?:([\d.]+)S)?)?$')
+
+    def __init__(self, cache_size=10000):
+        """
+        :param cache_size: max count of memoized resolutions.
+        """
+        self._cache = LRUCache(cache_size)
+        self._local = threading.local()
+
+    @property
+    def calendar(self):
+        cal = getattr(self._local, 'calendar', None)
+        if cal is None:
+            cal = self._local.calendar = parsedatetime.Calendar()
+        return cal
+
+    def parse_base_time(self, text):
+        """
+        :param text: time in format of Twitter created_at. (such as "Thu Jun 15 12:00:00 +0000 2017")
+        :return: timezone aware datetime
+        """
+        try:
+            week, month, day, clock, offset, year = text.split()
+            hour, minute, second = clock.split(':')
+            sign = -1 if offset[0] == '-' else 1
+            tz = timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5])))
+            return datetime(int(year), self._months[month], int(day), int(hour), int(minute), int(second), tzinfo=tz)
+        except (ValueError, KeyError, IndexError):
+            return datetime.strptime(text, '%a %b %d %H:%M:%S %z %Y')
+
+    def resolve(self, tp, value, text, base_time):
+        """
+        :param tp: TIMEX3 type (DATE, TIME, DURATION, SET)
+        :param value: TIMEX3 value
+        :param text: text of the expression
+        :param base_time: base datetime
+        :return: dict of "v" (resolved naive datetime or None) and "duration"/"recurrence" if any.
+        """
+        base = base_time.replace(tzinfo=None)      # resolved by wall clock of the base time
+        key = self._key(tp, value or '', text, base)
+        resolved = self._cache.get(key)
+        if resolved is None:
+            resolved = self._resolve(tp, value or '', text, base)
+            if resolved.get('v') is None and tp in ('DATE', 'TIME') and not self._re_unresolvable.match(value or ''):
+                resolved['v'] = self.parse_text(text, base_time)
+            self._cache.set(key, resolved)
+        return dict(resolved)
+
+    def _key(self, tp, value, text, base):
+        """
+        :return: memo key of a resolution. Only as much of the base time as the resolution depends on is kept,
+                 so expressions of statuses posted on the same day share entries.
+        """
+        if tp in ('DATE', 'TIME'):
+            if self._re_datetime.match(value) or self._re_week.match(value):
+                return tp, value                    # absolute
+            m = self._re_part.match(value)
+            if m:
+                return (tp, value) if m.group(1) else (tp, value, base.date())
+            if self._re_clock.match(value):
+                return tp, value, base.date()
+        # durations, recurrences, PRESENT_REF and text fallback are relative to the time of day.
+        return tp, value, text, base
+
+    def parse_text(self, text, base_time):
+        """
+        Parse datetime from text in natural language.
+        :return: naive datetime
+        """
+        return datetime(*self.calendar.parse(text, sourceTime=base_time)[0][:6])
+
+    def _resolve(self, tp, value, text, base):
+        if tp == 'DURATION':
+            seconds = self._duration(value)
+            if seconds is None:
+                return {'v': None}
+            return {'v': base + timedelta(seconds=seconds), 'duration': seconds}
+
+        if tp == 'SET':
+            seconds = self._duration(value)
+            if seconds is not None:
+                return {'v': base + timedelta(seconds=seconds), 'recurrence': value}
+            v = self._part_of_day(value, base)
+            if v is not None and v <= base:
+                v += timedelta(days=1)
+            return {'v': v, 'recurrence': value}
+
+        if value == 'PRESENT_REF':
+            return {'v': base}
+
+        m = self._re_datetime.match(value)
+        if m:
+            year, month, day, hour, minute, second = (int(g) if g else None for g in m.groups())
+            return {'v': datetime(year, month or 1, day or 1, hour or 0, minute or 0, second or 0)}
+
+        m = self._re_week.match(value)
+        if m:
+            return {'v': datetime.strptime('%s-W%s-1' % m.groups(), '%G-W%V-%u')}
+
+        m = self._re_clock.match(value)
+        if m:
+            hour, minute, second = (int(g) if g else 0 for g in m.groups())
+            return {'v': base.replace(hour=hour, minute=minute, second=second, microsecond=0)}
+
+        return {'v': self._part_of_day(value, base)}
+
+    def _part_of_day(self, value, base):
+        m = self._re_part.match(value)
+        if not m:
+            return None
+        year, month, day, part = m.groups()
+        if year:
+            base = datetime(int(year), int(month), int(day))
+        return base.replace(hour=self._part_hours[part], minute=0, second=0, microsecond=0)
+
+    def _duration(self, value):
+        """
+        :return: seconds of ISO 8601 duration, or None if not a duration or has unknown quantities.
+        """
+        m = self._re_duration.match(value)
+        if not m or not any(m.groups()):
+            return None
+        return sum(float(g) * seconds for g, (unit, seconds) in zip(m.groups(), self._duration_units) if g)
+
+
 class Timex3Parser(object):
 
     _formatter = HtmlFormatter(encoding='utf-8', nowrap=False, style='emacs', linenos=False,
@@ -27,7 +184,21 @@ class Timex3Parser(object):
     _lexer = XmlLexer()
     _css = _formatter.get_style_defs()
 
-    _re_hash = re.compile(r'(?:\A|\s)(?P<hash>#(?:\w|\.|_)+)(?:\s|\Z)', re.IGNORECASE + re.MULTILINE)
+    # a hash tag is surrounded by white spaces (or text boundaries). "#todolist" and "a#todo" are not "#todo".
+    _re_hash = re.compile(r'(?<!\S)(?P<hash>#(?:\w|\.|_)+)(?!\S)', re.IGNORECASE + re.MULTILINE)
+
+    valid_tags = ('todo', 'wish')       # tags of statuses to be parsed as tasks
+    _text_separator = '\x00'           # joins texts to match at once. never in status texts.
+    _re_valid_hash = re.compile(r'(?<![^\s\x00])#(?:%s)(?![^\s\x00])' % '|'.join(valid_tags), re.IGNORECASE)
+
+    _date_resolver = None
+
+    # a document is from optional xml declaration to end of its root element.
+    _re_document = re.compile(r'(?:<\?xml[^>]*\?>\s*)?<(?P<root>[A-Za-z_][\w.-]*)(?:\s[^>]*)?>.*?</(?P=root)\s*>',
+                              re.DOTALL)
+    _re_declaration = re.compile(r'<\?xml[^>]*\?>')
+    _documents_tag = '_documents_'  # wraps concatenated documents into one xml stream
+    _chunk_size = 64 * 1024     # size of text fed to xml parser at a time
 
     def __init__(self):
         pass
@@ -62,151 +233,202 @@ class Timex3Parser(object):
 
         return tags
 
-    @staticmethod
-    def parse_dates(timex3_xml):
+    @classmethod
+    def has_valid_tags(cls, texts):
+        """
+        Classify texts by whether they have any of valid hash tags. All texts are matched by one regex scan.
+        :param texts: list of text
+        :return: list of bool in the order of texts
+        """
+        flags = [False] * len(texts)
+        if not texts:
+            return flags
+
+        offsets = []
+        pos = 0
+        for text in texts:
+            offsets.append(pos)
+            pos += len(text or '') + 1
+        joined = cls._text_separator.join(text or '' for text in texts)
+
+        pos = 0
+        while True:
+            m = cls._re_valid_hash.search(joined, pos)
+            if m is None:
+                break
+            i = bisect_right(offsets, m.start()) - 1
+            flags[i] = True
+            if i + 1 >= len(offsets):
+                break
+            pos = offsets[i + 1]    # skip rest of the matched text
+        return flags
+
+    @classmethod
+    def get_date_resolver(cls):
+        if cls._date_resolver is None:
+            cls._date_resolver = DateResolver()
+        return cls._date_resolver
+
+    @classmethod
+    def _iter_chunks(cls, source):
+        if isinstance(source, str):
+            for pos in range(0, len(source), cls._chunk_size):
+                yield source[pos:pos + cls._chunk_size]
+        else:
+            for chunk in iter(lambda: source.read(cls._chunk_size), ''):
+                yield chunk
+
+    @classmethod
+    def iter_nodes(cls, source):
+        """
+        Stream TIMEX3 documents and yield nodes while parsing. Source is fed to the xml parser by chunks and
+        elements are freed once yielded, so memory is bounded by a document, not by the source.
+        :param source: TIMEX3 xml, or file-like object of it. May be concatenated documents (such as of a batch
+                       response).
+        :return: generator of (index of document, tag, dict of node). Tags are in order of:
+                 "DATE" (base time text in "text"),
+                 "TIMEX3" (attributes and "text"),
+                 "TEXT" (full text with tags stripped in "text"),
+                 "DOCUMENT" (end of document)
+        """
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        parser.feed('<%s>' % cls._documents_tag)
+        stack = []          # open elements. the wrapper first.
+        index = -1
+        text_elem = None    # TEXT element being parsed
+        parts = []          # text parts of TEXT read so far
+        pending = None      # ended child of TEXT. removed once its tail is read.
+        rest = ''
+        for chunk in cls._iter_chunks(source):
+            data = rest + chunk
+            # hold back an incomplete tag, which may be an xml declaration to strip.
+            cut = data.rfind('<')
+            if cut >= 0 and '>' not in data[cut:]:
+                data, rest = data[:cut], data[cut:]
+            else:
+                rest = ''
+            parser.feed(cls._re_declaration.sub('', data))
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    if len(stack) == 1:
+                        index += 1
+                    elif text_elem is not None and stack[-1] is text_elem:
+                        if pending is not None:
+                            parts.append(pending.tail or '')
+                            text_elem.remove(pending)
+                            pending = None
+                        elif not parts:
+                            parts.append(text_elem.text or '')
+                    elif elem.tag == 'TEXT':
+                        text_elem, parts = elem, []
+                    stack.append(elem)
+                    continue
+
+                stack.pop()
+                if elem.tag == 'DATE':
+                    yield index, 'DATE', {'text': elem.text}
+                elif elem.tag == 'TIMEX3':
+                    node = dict(elem.items())
+                    node['text'] = elem.text
+                    yield index, 'TIMEX3', node
+                elif elem is text_elem:
+                    if pending is not None:
+                        parts.append(pending.tail or '')
+                        text_elem.remove(pending)
+                    text = ''.join(parts) if parts else elem.text or ''
+                    text_elem, parts, pending = None, [], None
+                    yield index, 'TEXT', {'text': text}
+
+                if text_elem is not None and stack[-1] is text_elem:
+                    # text is kept until the tail is read. (tail is set on reading the next tag)
+                    parts.append(''.join(elem.itertext()))
+                    pending = elem
+                    elem.clear()
+                elif len(stack) == 1:
+                    stack[0].remove(elem)
+                    elem.clear()
+                    yield index, 'DOCUMENT', {}
+                elif elem.tag in ('DATE', 'TIMEX3', 'TEXT'):
+                    elem.clear()
+
+        parser.feed(cls._re_declaration.sub('', rest) + '</%s>' % cls._documents_tag)
+        parser.close()
+
+    @classmethod
+    def _resolve_node(cls, node, base_time):
+        """
+        :return: the node with resolved date "v", or None if fail to resolve.
+        """
+        if not node['text']:
+            return None
+        try:
+            node.update(cls.get_date_resolver().resolve(node.get('type'), node.get('value'), node['text'], base_time))
+        except Exception as err:
+            log.warn(err)
+            node['v'] = None
+
+        if node.get('v'):
+            return node
+        log.warn('Fail/ignored date: %s' % node)
+        return None
+
+    @classmethod
+    def parse_dates(cls, timex3_xml):
         """
-        extract all mentioned dates.
+        extract all mentioned dates (of the first document).
+
+        Each date is a dict of TIMEX3 attributes (tid, type, value, ...), "text" and resolved "v" (datetime).
+        DURATION also has "duration" (seconds) and SET has "recurrence" (TIMEX3 value). See DateResolver.
         :param timex3_xml:
         :return:
         """
         dates = []
-        cal = parsedatetime.Calendar()
-
-        xml = ET.fromstring(timex3_xml)
-
-        # base time
-        node = xml.findtext("./DATE")
-        base_time = datetime.strptime(node, '%a %b %d %H:%M:%S %z %Y')
-
-        '''
-        Fail dates:
-
-            DURATION PT24H 24 hours
-            DURATION P1D day
-            SET P1D each day
-            DURATION P1D day
-            SET P1D Daily
-            DURATION PT1M a Minute
-            DURATION P1D day
-            DURATION P1W Week
-            DURATION P1W Week
-            DURATION P1D day
-            DURATION P1D day
-            DURATION P1D Day
-            SET P1D Daily
-            DURATION P1D Day
-            SET P1D Daily
-            SET P1W Weekly
-            SET P1W Weekly
-            DURATION P22Y 22-year-old
-            SET P1D daily
-            DURATION P1W week
-            SET TMO every morning
-            DURATION P1W week
-            SET TMO every morning
-            DURATION P1W week
-            SET TMO every morning
-            DURATION P1D a day
-            TIME T19:00 7pm
-            DURATION PXY years
-            SET P1D Daily
-            SET P1D daily
-            DURATION P1D One day
-            DURATION P1D day
-            DURATION P1D a day
-            DURATION P1W a week
-            DURATION P1M a month
-            DURATION P1M a month
-            DURATION PXY years
-            DURATION P1D DAY
-            TIME T19:00 7pm
-            TIME TMO morning
-            DURATION P21D Less than 21 days
-            DURATION PT19S the last 19 seconds
-            SET P1D Daily
-            DURATION P1D day
-            DURATION PXY years
-            DURATION P1D Day
-            SET P1D Daily
-            DURATION P1D Day
-            SET P1D Daily
-            DURATION PXD days
-            DURATION PT3M 3 mins
-            DURATION P1W a week
-            SET P1D daily
-            SET P1D daily
-            TIME TMO Morning
-            DURATION P1W week
-            DURATION PT40S more than 40 seconds
-            SET P1D daily
-            DURATION P1W Week
-            SET P1D daily
-            SET P1D daily
-            DURATION P1W Week
-            DURATION P9W 9 weeks
-            DURATION P9W 9 weeks
-            DURATION P1D one day
-            DURATION P1D day
-            DURATION P1D Day
-            SET P1D Daily
-            DURATION P1D day
-            DURATION PXD few days
-            SET P1D every day
-            SET P1D every day
-            SET P1W Weekly
-            TIME TMO the next morning
-            TIME TEV evening
-            DURATION P1D day
-            TIME TMO morning
-        '''
-
-        for node in xml.findall("./TEXT/TIMEX3"):
-            dt = {}
-            dt['text'] = node.text
-            for k, v in node.items():
-                dt[k] = v
-            tp = dt['type']
-            if dt['text']:
-                if tp == 'DATE':
-                    try:
-                        # TODO: need to be parsed depends on date (when crawling)
-                        value = dt['value']
-                        # if value == 'PRESENT_REF':
-                        #     v = dateparser.parse(dt['date'])
-                        # elif value == 'PAST_REF':
-                        #     v = None
-                        #     pass
-                        # elif value == 'FUTURE_REF':
-                        #     v = None
-                        #     pass
-                        # elif value == 'XXXX':
-                        #     v = dateparser.parse(dt['text'])
-                        if value.startswith('XXXX-'):
-                            # token = value.split('-')[1]
-                            v = None
-                            pass
-                        else:
-                            v = datetime(*cal.parse(dt['text'], sourceTime=base_time)[0][:6])
-                        dt['v'] = v
-                    except Exception as err:
-                        log.warn(err)
-                        dt['v'] = None
-                elif tp == 'TIME':
-                    dt['v'] = datetime(*cal.parse(dt['text'], sourceTime=base_time)[0][:6])
-                elif tp == 'DURATION':
-                    pass
-                elif tp == 'SET':
-                    pass
-                else:
-                    pass
-
-                if 'v' in dt and dt['v']:
-                    dates.append(dt)
-                else:
-                    log.warn('Fail/ignored date: %s' % dt)
-
+        base_time = None
+        for index, tag, node in cls.iter_nodes(timex3_xml):
+            if index > 0 or tag == 'DOCUMENT':
+                break
+            if tag == 'DATE':
+                base_time = cls.get_date_resolver().parse_base_time(node['text'])
+            elif tag == 'TIMEX3':
+                node = cls._resolve_node(node, base_time)
+                if node:
+                    dates.append(node)
         return dates
 
+    @classmethod
+    def extract(cls, source, include_highlight=False):
+        """
+        Extract dates, tags (and highlight) of TIMEX3 documents in one pass.
+        :param source: TIMEX3 xml. May be concatenated documents (such as of a batch response).
+        :param include_highlight: whether render highlighted html of documents. (source must be str)
+        :return: list of dict per document. keys are "text", "dates", "tags", compact JSON of
+                 "dates_json" and "tags_json", and "highlight" (None if not included).
+        """
+        docs = []
+        base_time = None
+        # documents of source for highlight, found lazily along with parsing.
+        sources = (m.group(0) for m in cls._re_document.finditer(source)) if include_highlight else None
+        for index, tag, node in cls.iter_nodes(source):
+            if index >= len(docs):
+                docs.append({'text': '', 'dates': [], 'tags': [], 'highlight': None})
+                base_time = None
+            doc = docs[index]
+            if tag == 'DATE':
+                base_time = cls.get_date_resolver().parse_base_time(node['text'])
+            elif tag == 'TIMEX3':
+                node = cls._resolve_node(node, base_time)
+                if node:
+                    doc['dates'].append(node)
+            elif tag == 'TEXT':
+                doc['text'] = node['text']
+                doc['tags'] = cls.parse_hash_tags(node['text'])
+            elif tag == 'DOCUMENT':
+                doc['dates_json'] = json.dumps(doc['dates'], separators=(',', ':'), default=to_serializable)
+                doc['tags_json'] = json.dumps(doc['tags'], separators=(',', ':'))
+                if include_highlight:
+                    doc['highlight'] = cls.highlight(next(sources, ''))
+        return docs
+
     @classmethod
     def highlight(cls, src):
         code = highlight(src, cls._lexer, cls._formatter)
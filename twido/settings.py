@@ -102,6 +102,25 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+# Must be shared by all processes (uwsgi workers, fetch and remind commands). Cached tasks and configs are
+# invalidated by the process saving them. Default (local memory) cache is per process, so other processes would
+# serve stale entries. Use memcached (such as 'django.core.cache.backends.memcached.MemcachedCache') if running
+# on more than one host.
+# MAX_ENTRIES is sized for about 5 entries per profile (version keys and entries of tasks and configs) of 20000
+# profiles. Once exceeded, a third of the entries (including version keys) are culled at random on each set.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -6,6 +6,11 @@ Utilities
 """
 
 import configparser
+import threading
+import time
+from collections import OrderedDict
+from django.core.cache import caches
+from django.db import connection, transaction
 from pyutils.langutil import MutableEnum
 
 import logging
@@ -35,6 +40,121 @@ def parse_datetime(string):
     return datetime(*(parsedate(string)[:6]))
 
 
+class LRUCache(object):
+    """
+    Thread safe, size bounded dict. Least recently used entries are evicted when full.
+    """
+
+    def __init__(self, maxsize=10000):
+        """
+        :param maxsize: max count of entries.
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class VersionedCache(object):
+    """
+    Entries of owners (such as profiles) in a Django cache backend, keyed with a version per owner.
+    Invalidating an owner changes its version, so all its entries are dropped at once (and left to expire).
+    """
+
+    def __init__(self, prefix, timeout=300, alias='default'):
+        """
+        :param prefix: prefix of keys.
+        :param timeout: seconds to keep entries.
+        :param alias: alias of cache in settings.CACHES
+        """
+        self.prefix = prefix
+        self.timeout = timeout
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_version(self, owner):
+        key = '%s:v:%s' % (self.prefix, owner)
+        version = self.cache.get(key)
+        if version is None:
+            # never reuse versions of evicted version keys.
+            self.cache.add(key, int(time.time() * 1000000), None)
+            version = self.cache.get(key)
+        return version
+
+    def invalidate(self, owner):
+        """
+        Invalidate at once, and again on commit if in a transaction.
+        (entries cached by concurrent readers before commit are of the rows before the transaction)
+        """
+        self._renew_version(owner)
+        if connection.in_atomic_block:
+            transaction.on_commit(lambda: self._renew_version(owner))
+
+    def _renew_version(self, owner):
+        self.cache.set('%s:v:%s' % (self.prefix, owner), int(time.time() * 1000000), None)
+
+    def make_key(self, owner, name):
+        return '%s:%s:%s:%s' % (self.prefix, owner, self.get_version(owner), name)
+
+    def get(self, owner, name, default=None):
+        return self.cache.get(self.make_key(owner, name), default)
+
+    def set(self, owner, name, value):
+        self.cache.set(self.make_key(owner, name), value, self.timeout)
+
+    def get_or_set(self, owner, name, load):
+        """
+        :param load: function returns the value if not cached.
+        """
+        key = self.make_key(owner, name)
+        value = self.cache.get(key)
+        if value is None:
+            value = load()
+            self.cache.set(key, value, self.timeout)
+        return value
+
+
 def send_reg_email(email, id, name=None):
     folder = './data/email/'
     path = folder + email + '.html'
@@ -1,15 +1,13 @@
 #!/usr/bin/env python
 # coding: utf-8
-from django.db.models import Q
 from django.views.generic.base import ContextMixin
 from django.contrib import messages
 from django.utils import translation
 from django.conf import settings
-from django.utils import timezone
 
 from ..models import Config
 from ..models import UserProfile
-from ..models import Task, TaskStatus
+from ..models import Task
 
 
 class BaseViewMixin(ContextMixin):
@@ -18,14 +16,15 @@ class BaseViewMixin(ContextMixin):
         context = super(BaseViewMixin, self).get_context_data(**kwargs)
 
         profile = self.get_profile()
+        confs = Config.get_user_confs(profile)
 
         if 'theme' not in context:
-            opt = Config.get_user_conf(profile, 'theme')
+            opt = confs.get('theme')
             context['theme'] = opt.value if opt else 'simplex'
 
         if not profile.is_faked and 'LANGUAGE_CODE' not in context:
             # only set for REAL users (they have lang setting)
-            opt = Config.get_user_conf(profile, 'lang')
+            opt = confs.get('lang')
             if opt:
                 # only set if user configured language in setting.
                 # otherwise, use middleware detected.
@@ -33,7 +32,7 @@ class BaseViewMixin(ContextMixin):
                 translation.activate(context['LANGUAGE_CODE'])
 
         # if 'view_size' not in context:
-        #     opt = Config.get_user_conf(profile, 'view_size')
+        #     opt = confs.get('view_size')
         #     context['view_size'] = opt.value if opt else 'G'
 
         if 'website' not in context:
@@ -70,9 +69,4 @@ class BaseViewMixin(ContextMixin):
         return profile
 
     def get_expiring_tasks(self, hours=3, days=0):
-        profile = self.get_profile()
-        start = timezone.now()
-        end = start + timezone.timedelta(days=days, hours=hours)
-        tasks = Task.objects.filter(profile=profile, due__gte=start, due__lte=end).filter(
-            ~Q(status=TaskStatus.CANCEL) & ~Q(status=TaskStatus.DONE)).order_by('due')
-        return tasks
\ No newline at end of file
+        return Task.get_expiring(self.get_profile(), hours=hours, days=days)
\ No newline at end of file
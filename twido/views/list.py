@@ -19,7 +19,8 @@ from pyutils.django.response import download_file_response
 import simplejson as json
 from pyutils.json import to_serializable
 
-from ..models import Task,  List, TaskStatus, SysList, Visibility
+from ..models import Task,  List, TaskStatus, SysList, Visibility, TaskChange
+from ..models.task import task_cache
 from .base import BaseViewMixin
 from .common import paginate
 
@@ -211,6 +212,9 @@ class ListView(TemplateView, BaseViewMixin):
                                 t.raw = None
                                 tasks.append(t)
                             TaskModel.objects.bulk_create(tasks)
+                            # bulk_create sends no signals (and may not set ids). record schedules for reminder.
+                            TaskChange.record_all(TaskModel.objects.filter(list=lst, due__isnull=False))
+                            task_cache.invalidate(profile.id)
                             self.success(I18N_MSGS.list_imported)
                             return redirect(self.get_view_name(), pk=lst.id)
                     except Exception as err:
@@ -20,12 +20,7 @@ class SettingView(TemplateView, BaseViewMixin):
         p = self.request.user.profile
         context['profile'] = p
 
-        # TODO: optimization required
-        # context['x'] = sorted(Config.objects.filter(profile=p).values('name', 'value'), key=lambda x:x['name'])
-        conf = {}
-        for opt in Config.objects.filter(profile=p):
-            conf[opt.name] = opt
-        context['conf'] = conf
+        context['conf'] = Config.get_user_confs(p)
 
         # social account linking
         context['social_platforms'] = SocialPlatform
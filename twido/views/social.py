@@ -135,7 +135,7 @@ class SocialView(TemplateView, BaseViewMixin):
                     if timezone.now() - acc.timestamp < timedelta(hours=3):
                         resp = HttpResponse(I18N_MSGS.too_frequent % acc.timestamp, status=406)
                         return resp
-                    self.update_twitter_account(json.loads(acc.tokens), acc.profile, commit=True)
+                    self.update_twitter_account(acc.tokens, acc.profile, commit=True)
                     data = {'name': acc.name}
                     self.success(I18N_MSGS.social_profile_updated)
                     return JsonResponse(data)
@@ -245,7 +245,7 @@ class SocialView(TemplateView, BaseViewMixin):
             except SocialAccount.DoesNotExist:
                 acc = SocialAccount(profile=profile)
 
-            acc.tokens = json.dumps(tokens, indent=2, ensure_ascii=False)
+            acc.tokens = tokens
             acc.platform = SocialPlatform.TWITTER
             acc.account = user.screen_name
             acc.name = user.name